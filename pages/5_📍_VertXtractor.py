@@ -1,14 +1,33 @@
 import streamlit as st
-import urllib
-import json
 from pathlib import Path
 import datetime
 import folium
 from streamlit_folium import folium_static
 import geopandas as gpd
+import pandas as pd
+import shapely
 import tempfile
 import os
 
+from vertgis.download import format_bytes, MAX_WORKERS
+from vertgis.catalog import get_items, get_items_many, lookup_assets, asset_checksum
+from vertgis.store import assemble
+from vertgis.preflight import estimate, split_batches, record_rate, batch_scope, filter_scope
+from vertgis.jobs import create as create_job, load as load_job, log_result, finish as finish_job, pending as pending_urls, unfinished as unfinished_jobs, lock as lock_job
+from vertgis.config import JOB_MAX_BYTES, JOB_OVER_BUDGET
+from vertgis.mosaic import build_mosaics
+from vertgis.derivatives import compute_derivatives, PRODUCTS as DERIVATIVES
+from vertgis.canopy import compute_canopy, CANOPY_THRESHOLD
+from vertgis.zonal import zonal_stats, STATS as ZONAL_STATS
+from vertgis.buildings import convert, read_buildings
+from vertgis.tiles3d import build_tileset, MAX_BUILDINGS_PER_TILE
+from vertgis.terrain import build_terrain, MAX_ERROR as TERRAIN_MAX_ERROR
+from vertgis.manifest import new_manifest, find_extractions, load as load_manifest, save as save_manifest, record as record_manifest, diff as diff_manifest
+from vertgis.arcgis import iter_features, features_to_gpkg
+from vertgis.clip import clip_cogs
+from vertgis.grid import tiles_for_bbox, tiles_for_geometry, resolve_tiles, select_intersecting
+from vertgis.reframe import bbox_wgs84_to_lv95, bbox_lv95_to_wgs84, transform_points, WGS84, LV95
+
 # Constants
 CATEGORIES = {
     'Gebueschwald': 'Forêt buissonnante',
@@ -18,6 +37,7 @@ CATEGORIES = {
 }
 
 MERGE_CATEGORIES = True
+URL_FOREST_LAYER = 'https://hepiadata.hesge.ch/arcgis/rest/services/suisse/TLM_C4D_couverture_sol/FeatureServer/1'
 URL_STAC_SWISSTOPO_BASE = 'https://data.geo.admin.ch/api/stac/v0.9/collections/'
 DIC_LAYERS = {
     'ortho': 'ch.swisstopo.swissimage-dop10',
@@ -28,19 +48,6 @@ DIC_LAYERS = {
 }
 
 # Functions
-def wgs84_to_lv95(lat, lon):
-    url = f'http://geodesy.geo.admin.ch/reframe/wgs84tolv95?easting={lat}&northing={lon}&format=json'
-    site = urllib.request.urlopen(url)
-    data = json.load(site)
-    return data['easting'], data['northing']
-
-def lv95_to_wgs84(x, y):
-    url = f'http://geodesy.geo.admin.ch/reframe/lv95towgs84?easting={x}&northing={y}&format=json'
-    f = urllib.request.urlopen(url)
-    txt = f.read().decode('utf-8')
-    json_res = json.loads(txt)
-    return json_res
-
 def detect_and_convert_bbox(bbox):
     xmin, ymin, xmax, ymax = bbox
     wgs84_margin = 0.9
@@ -62,54 +69,40 @@ def detect_and_convert_bbox(bbox):
         wgs84_bounds['ymin'] <= ymin <= wgs84_bounds['ymax'] and
         wgs84_bounds['xmin'] <= xmax <= wgs84_bounds['xmax'] and
         wgs84_bounds['ymin'] <= ymax <= wgs84_bounds['ymax']):
-        lv95_min = wgs84_to_lv95(xmin, ymin)
-        lv95_max = wgs84_to_lv95(xmax, ymax)
-        bbox_lv95 = (lv95_min[0], lv95_min[1], lv95_max[0], lv95_max[1])
+        bbox_lv95 = bbox_wgs84_to_lv95(bbox)
         return (bbox, bbox_lv95)
     
     if (lv95_bounds['xmin'] <= xmin <= lv95_bounds['xmax'] and
         lv95_bounds['ymin'] <= ymin <= lv95_bounds['ymax'] and
         lv95_bounds['xmin'] <= xmax <= lv95_bounds['xmax'] and
         lv95_bounds['ymin'] <= ymax <= lv95_bounds['ymax']):
-        wgs84_min = lv95_to_wgs84(xmin, ymin)
-        wgs84_max = lv95_to_wgs84(xmax, ymax)
-        bbox_wgs84 = (wgs84_min['easting'], wgs84_min['northing'], wgs84_max['easting'], wgs84_max['northing'])
+        bbox_wgs84 = bbox_lv95_to_wgs84(bbox)
         return (bbox_wgs84, bbox)
     
     return None
 
-def get_list_from_STAC_swisstopo(url, est, sud, ouest, nord, gdb=False):
+def assets_from_items(items, gdb=False):
     if gdb:
         lst_indesirables = []
     else:
         lst_indesirables = ['.xyz.zip', '.gdb.zip']
-    
-    sufixe_url = f"/items?bbox={est},{sud},{ouest},{nord}"
-    url += sufixe_url
+
     res = []
-    
-    while url:
-        f = urllib.request.urlopen(url)
-        txt = f.read().decode('utf-8')
-        json_res = json.loads(txt)
-        url = None
-        links = json_res.get('links', None)
-        if links:
-            for link in links:
-                if link['rel'] == 'next':
-                    url = link['href']
-        for item in json_res['features']:
-            for k, dic in item['assets'].items():
-                href = dic['href']
-                if gdb:
-                    if href[-8:] == '.gdb.zip':
-                        if len(dic['href'].split('/')[-1].split('_')) == 7:
-                            res.append(dic['href'])
-                else:
-                    if href[-8:] not in lst_indesirables:
+    for item in items:
+        for k, dic in item['assets'].items():
+            href = dic['href']
+            if gdb:
+                if href[-8:] == '.gdb.zip':
+                    if len(dic['href'].split('/')[-1].split('_')) == 7:
                         res.append(dic['href'])
+            else:
+                if href[-8:] not in lst_indesirables:
+                    res.append(dic['href'])
     return res
 
+def get_list_from_STAC_swisstopo(url, est, sud, ouest, nord, gdb=False):
+    return assets_from_items(get_items(url, (est, sud, ouest, nord)), gdb)
+
 def suppr_doublons_list_ortho(lst):
     dic = {}
     for url in lst:
@@ -122,41 +115,61 @@ def suppr_doublons_list_ortho(lst):
     return res
 
 def get_urls(bbox_wgs84, mnt=True, mns=True, bati3D_v2=True, bati3D_v3=True, ortho=True, mnt_resol=0.5, ortho_resol=0.1):
-    est, sud, ouest, nord = bbox_wgs84
+    selected = {'mnt': mnt, 'mns': mns, 'bati3D_v2': bati3D_v2, 'bati3D_v3': bati3D_v3, 'ortho': ortho}
+    # All collections are listed concurrently (from the local catalogue when
+    # it is fresh enough), then merged in a fixed order
+    items = get_items_many({k: URL_STAC_SWISSTOPO_BASE + DIC_LAYERS[k] for k, v in selected.items() if v}, bbox_wgs84)
     urls = []
 
     if mnt:
         mnt_resol = 0.5 if mnt_resol < 2 else 2
         tri = f'_{mnt_resol}_'
-        url = URL_STAC_SWISSTOPO_BASE + DIC_LAYERS['mnt']
-        lst = [v for v in get_list_from_STAC_swisstopo(url, est, sud, ouest, nord) if tri in v]
+        lst = [v for v in assets_from_items(items['mnt']) if tri in v]
         urls += lst
 
     if mns:
-        url = URL_STAC_SWISSTOPO_BASE + DIC_LAYERS['mns']
-        lst = [v for v in get_list_from_STAC_swisstopo(url, est, sud, ouest, nord) if 'raster' in v]
+        lst = [v for v in assets_from_items(items['mns']) if 'raster' in v]
         urls += lst
 
     if bati3D_v2:
-        url = URL_STAC_SWISSTOPO_BASE + DIC_LAYERS['bati3D_v2']
-        lst = get_list_from_STAC_swisstopo(url, est, sud, ouest, nord)
+        lst = assets_from_items(items['bati3D_v2'])
         urls += lst
 
     if bati3D_v3:
-        url = URL_STAC_SWISSTOPO_BASE + DIC_LAYERS['bati3D_v3']
-        lst = get_list_from_STAC_swisstopo(url, est, sud, ouest, nord, gdb=True)
+        lst = assets_from_items(items['bati3D_v3'], gdb=True)
         urls += lst
 
     if ortho:
         ortho_resol = 0.1 if ortho_resol < 2 else 2
         tri = f'_{ortho_resol}_'
-        url = URL_STAC_SWISSTOPO_BASE + DIC_LAYERS['ortho']
-        lst = [v for v in get_list_from_STAC_swisstopo(url, est, sud, ouest, nord) if tri in v and v.endswith('.png')]
+        lst = [v for v in assets_from_items(items['ortho']) if tri in v and v.endswith('.png')]
         lst = suppr_doublons_list_ortho(lst)
         urls += lst
 
     return urls
 
+def get_urls_from_grid(bbox_wgs84, bbox_lv95, mnt=True, mns=True, bati3D_v2=True, bati3D_v3=True, ortho=True, mnt_resol=0.5, ortho_resol=0.1, aoi=None):
+    # Raster products are on the 1 km grid: their URLs are computed locally and
+    # only checked with HEAD requests. Buildings are not, they still use STAC.
+    tiles = tiles_for_geometry(aoi) if aoi is not None else tiles_for_bbox(bbox_lv95)
+    urls = []
+
+    if mnt:
+        mnt_resol = 0.5 if mnt_resol < 2 else 2
+        urls += resolve_tiles('mnt', tiles, mnt_resol)
+
+    if mns:
+        urls += resolve_tiles('mns', tiles, 0.5)
+
+    if bati3D_v2 or bati3D_v3:
+        urls += get_urls(bbox_wgs84, False, False, bati3D_v2, bati3D_v3, False)
+
+    if ortho:
+        ortho_resol = 0.1 if ortho_resol < 2 else 2
+        urls += resolve_tiles('ortho', tiles, ortho_resol)
+
+    return urls
+
 def classification_urls(urls):
     dic = {}
     for url in urls:
@@ -193,40 +206,229 @@ def classification_urls(urls):
         dic.setdefault(dirname, []).append((url, fn))
     return dic
 
-def download_files(urls, path):
-    now = datetime.datetime.now()
-    path = Path(path) / f'swisstopo_extraction_{now.strftime("%Y%m%d_%H%M")}'
-    path.mkdir(exist_ok=True)
+def list_urls(query):
+    options = [query[k] for k in ('mnt', 'mns', 'bati3D_v2', 'bati3D_v3', 'ortho', 'mnt_resol', 'ortho_resol')]
+    aoi = shapely.from_wkt(query['aoi_wkt']) if query.get('aoi_wkt') else None
+    if query.get('use_grid'):
+        urls = get_urls_from_grid(query['bbox_wgs84'], query['bbox_lv95'], *options, aoi=aoi)
+    else:
+        urls = get_urls(query['bbox_wgs84'], *options)
+    if aoi is not None:
+        # Only tiles touching the uploaded geometries, not all tiles of their bbox
+        urls = select_intersecting(urls, aoi)
+    return urls
+
+def clip_products(urls):
+    # COG rasters (MNT/MNS) grouped per product and resolution, oldest year first
+    dic = {}
+    for url in urls:
+        fn = url.split('/')[-1]
+        if fn.split('_')[0] in ('swissalti3d', 'swisssurface3d-raster') and fn.endswith('.tif'):
+            name, an, no_flle, resol, *a = fn.split('_')
+            resol = {'0.5': '50cm', '2': '2m'}.get(resol, resol)
+            dic.setdefault(f'{name}_{resol}_clip.tif', []).append((an, url))
+    return {k: [url for an, url in sorted(v)] for k, v in dic.items()}
+
+def fetch_into(path, urls, max_workers=MAX_WORKERS, on_progress=None, clip_bbox=None, on_result=None):
+    results = []
+    if clip_bbox is not None:
+        # Only the COG blocks inside the bbox are read, into one raster per product
+        clipped = set()
+        for fn, lst in clip_products(urls).items():
+            try:
+                clip_cogs(lst, clip_bbox, path / fn, max_workers)
+                size = (path / fn).stat().st_size
+                done = [{'url': url, 'path': path / fn, 'ok': True, 'size': size, 'error': None} for url in lst]
+            except Exception as e:
+                done = [{'url': url, 'path': path / fn, 'ok': False, 'size': 0, 'error': str(e)} for url in lst]
+            for r in done:
+                if on_result:
+                    on_result(r)
+            results += done
+            clipped.update(lst)
+        urls = [url for url in urls if url not in clipped]
+
+    jobs = []
     for k, v in classification_urls(urls).items():
         p = path / k
         p.mkdir(exist_ok=True)
         for url, fn in v:
-            urllib.request.urlretrieve(url, p / fn)
-    return path
+            jobs.append((url, p / fn))
+    # Assets already in the shared store are linked, only the others are downloaded
+    checksums = {url: asset_checksum(asset) for url, asset in lookup_assets(urls).items()}
+    results += assemble(jobs, checksums, max_workers=max_workers, on_progress=on_progress, on_result=on_result)
+    return results, checksums
 
-def geojson_forest(bbox, fn_geojson):
-    xmin, ymin, xmax, ymax = bbox
-    url_base = 'https://hepiadata.hesge.ch/arcgis/rest/services/suisse/TLM_C4D_couverture_sol/FeatureServer/1/query?'
+def download_files(urls, path, max_workers=MAX_WORKERS, on_progress=None, query=None):
+    now = datetime.datetime.now()
+    path = Path(path) / f'swisstopo_extraction_{now.strftime("%Y%m%d_%H%M%S")}'
+    path.mkdir(parents=True, exist_ok=True)
+    create_job(path, query, urls)
+    return run_job(path, max_workers, on_progress)
+
+def run_job(path, max_workers=MAX_WORKERS, on_progress=None):
+    # Fetch what the journal does not list as done yet, then write the manifest
+    path = Path(path)
+    held = lock_job(path)
+    if held is None:
+        raise RuntimeError(f"The job in {path} is running in another session")
+    try:
+        return _run_job(path, max_workers, on_progress)
+    finally:
+        held.close()
+
+def _run_job(path, max_workers, on_progress):
+    job = load_job(path)
+    query = job['query']
+    checksums = {url: asset_checksum(asset) for url, asset in lookup_assets(job['urls']).items()}
+    clip_bbox = query['bbox_lv95'] if query.get('clip') else None
+    todo = pending_urls(job)
+    if clip_bbox is not None:
+        # A clipped raster is rebuilt from all the tiles of its product
+        for fn, lst in clip_products(job['urls']).items():
+            if any(url in todo for url in lst):
+                todo += [url for url in lst if url not in todo]
+    results, _ = fetch_into(path, todo, max_workers, on_progress, clip_bbox,
+                            on_result=lambda r: log_result(path, r, checksums.get(r['url'])))
+    done = [r for url, r in job['done'].items() if url not in todo]
+    manifest = new_manifest(query)
+    save_manifest(path, record_manifest(manifest, path, done + results, checksums))
+    if query.get('mosaic'):
+        build_mosaics(path, manifest_products(manifest))
+    failed = [r for r in results if not r['ok']]
+    if not failed:
+        finish_job(path)
+    return path, failed
+
+def manifest_products(manifest):
+    # Product directories of the downloaded tiles (classification_urls), not derived outputs
+    return {Path(a['path']).parts[0] for a in manifest['assets'].values() if len(Path(a['path']).parts) > 1}
+
+def sync_files(path, max_workers=MAX_WORKERS, on_progress=None, prune=True):
+    # Re-run the saved query and only fetch what is new or changed since
+    path = Path(path)
+    manifest = load_manifest(path)
+    urls = list_urls(manifest['query'])
+    if 'scope' in manifest['query']:
+        # Extraction of one batch of a split job
+        urls = filter_scope(urls, manifest['query']['scope'])
+    checksums = {url: asset_checksum(asset) for url, asset in lookup_assets(urls).items()}
+    new, changed, removed = diff_manifest(manifest, urls, checksums)
+    todo = new + changed
+    clip_bbox = None
+    if manifest['query'].get('clip'):
+        # A clipped raster is rebuilt from all the current tiles of its product
+        clip_bbox = manifest['query']['bbox_lv95']
+        affected = {manifest['assets'][url]['path'] for url in removed}
+        for fn, lst in clip_products(urls).items():
+            if fn in affected or any(url in todo for url in lst):
+                todo += [url for url in lst if url not in todo]
+    results, checksums = fetch_into(path, todo, max_workers, on_progress, clip_bbox)
+    record_manifest(manifest, path, results, checksums)
+    if prune:
+        for url in removed:
+            rel = manifest['assets'].pop(url)['path']
+            if any(asset['path'] == rel for asset in manifest['assets'].values()):
+                continue
+            fn = path / rel
+            fn.unlink(missing_ok=True)
+            if fn.parent != path and fn.parent.exists() and not any(fn.parent.iterdir()):
+                fn.parent.rmdir()
+    save_manifest(path, manifest)
+    if manifest['query'].get('mosaic') and (todo or removed):
+        build_mosaics(path, manifest_products(manifest))
+    failed = [r for r in results if not r['ok']]
+    return new, changed, removed, failed
+
+def extraction_rasters(path, prefix):
+    # Mosaics (.vrt) and clipped rasters of a product at the top of an extraction
+    return sorted(p for p in Path(path).iterdir() if p.name.startswith(prefix) and p.suffix in ('.vrt', '.tif'))
+
+def extraction_aoi(path):
+    # Uploaded geometries of the query, else its bbox (LV95)
+    query = load_manifest(path)['query']
+    if query.get('aoi_wkt'):
+        return shapely.from_wkt(query['aoi_wkt'])
+    return shapely.box(*query['bbox_lv95'])
+
+def convert_buildings(path, max_workers=None):
+    # One GeoParquet folder per swissbuildings3d product directory of the extraction
+    path = Path(path)
+    aoi = extraction_aoi(path)
+    res = {}
+    for d in sorted(p for p in path.iterdir() if p.is_dir() and p.name.startswith('swissbuildings3d')):
+        archives = sorted(f for f in d.iterdir() if f.name.endswith('.zip'))
+        res[d.name] = convert(archives, path / f'{d.name}_parquet', aoi, max_workers)
+    return res
+
+def show_download_progress(bar, status):
+    def callback(progress):
+        callback.progress = progress
+        bar.progress(progress.fraction)
+        status.write(
+            f"{progress.done_files}/{progress.total_files} files - "
+            f"{format_bytes(progress.bytes_done)} at {format_bytes(progress.rate)}/s"
+        )
+    callback.progress = None
+    return callback
+
+def remember_throughput(callback):
+    # The measured rate feeds the duration of the next preflight estimates
+    progress = callback.progress
+    if progress is not None:
+        record_rate(progress.bytes_done, progress.elapsed)
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours} h {minutes:02d} min" if hours else f"{minutes} min {seconds:02d} s"
+
+def preflight(urls):
+    # Sizes and expected duration per product directory, and the batches within the budget
+    groups = {k: [url for url, fn in v] for k, v in classification_urls(urls).items()}
+    plan = estimate(groups)
+    if plan['download_bytes'] <= JOB_MAX_BYTES:
+        plan['batches'] = [urls]
+    elif JOB_OVER_BUDGET == 'refuse':
+        plan['batches'] = []
+    else:
+        plan['batches'] = split_batches(urls, plan['sizes'], JOB_MAX_BYTES, plan['stored'])
+    return plan
+
+def show_preflight(plan):
+    rows = [
+        {
+            'Product': product,
+            'Files': p['files'],
+            'Size': format_bytes(p['bytes']),
+            'To download': format_bytes(p['download_bytes']),
+            'Unknown size': p['unknown'],
+            'Expected duration': format_duration(p['download_bytes'] / plan['rate']),
+        }
+        for product, p in plan['products'].items()
+    ]
+    st.table(pd.DataFrame(rows))
+    rate = f"{format_bytes(plan['rate'])}/s" + ("" if plan['measured'] else " (default, not measured yet)")
+    st.write(
+        f"Total: {format_bytes(plan['bytes'])}, {format_bytes(plan['download_bytes'])} to download "
+        f"(~{format_duration(plan['seconds'])} at {rate})"
+    )
+    if plan['unknown']:
+        st.warning(f"{plan['unknown']} files did not report their size; the estimate is a lower bound.")
+
+def geojson_forest(bbox, fn_gpkg):
+    # Paged and tiled queries, streamed into a GeoPackage (see vertgis.arcgis)
     sql = ' OR '.join([f"OBJEKTART='{cat}'" for cat in CATEGORIES.keys()])
     params = {
-        "geometry": f"{xmin},{ymin},{xmax},{ymax}",
-        "geometryType": "esriGeometryEnvelope",
         "returnGeometry": "true",
         "outFields": "OBJEKTART",
-        "orderByFields": "OBJEKTART",
         "where": sql,
         "returnZ": "true",
+        "inSR": '2056',
         "outSR": '2056',
-        "spatialRel": "esriSpatialRelIntersects",
-        "f": "geojson"
     }
-    query_string = urllib.parse.urlencode(params)
-    url = url_base + query_string
-    with urllib.request.urlopen(url) as response:
-        response_data = response.read()
-        data = json.loads(response_data)
-    with open(fn_geojson, 'w') as f:
-        json.dump(data, f)
+    features = iter_features(URL_FOREST_LAYER, params, bbox)
+    return features_to_gpkg(features, fn_gpkg, {'OBJEKTART': 'str'})
 
 # Streamlit app
 st.set_page_config(page_title="Swiss Geospatial Data Downloader", layout="wide")
@@ -241,6 +443,10 @@ bati3D_v3 = st.sidebar.checkbox("3D Buildings v3", value=True)
 ortho = st.sidebar.checkbox("Orthophotos", value=True)
 mnt_resol = st.sidebar.selectbox("MNT Resolution", [0.5, 2.0], index=0)
 ortho_resol = st.sidebar.selectbox("Orthophoto Resolution", [0.1, 2.0], index=0)
+max_workers = st.sidebar.slider("Parallel downloads", 1, 16, MAX_WORKERS)
+use_grid = st.sidebar.checkbox("Compute raster tiles from the 1 km grid (skip STAC listing)", value=False)
+clip = st.sidebar.checkbox("Clip MNT/MNS to the bounding box (read only the needed COG blocks)", value=False)
+mosaic = st.sidebar.checkbox("Build a VRT mosaic with overviews per product", value=True)
 
 # Main content area
 st.subheader("Enter Bounding Box Coordinates")
@@ -256,6 +462,16 @@ with col4:
 
 if st.button("Set Bounding Box"):
     st.session_state.bbox = [xmin, ymin, xmax, ymax]
+    st.session_state.pop('aoi_wkt', None)
+
+aoi_file = st.file_uploader("...or upload an area of interest (GeoJSON, GeoPackage, KML)", type=["geojson", "gpkg", "kml"])
+if aoi_file is not None and st.button("Use Uploaded AOI"):
+    gdf_aoi = gpd.read_file(aoi_file)
+    if gdf_aoi.crs is None:
+        gdf_aoi = gdf_aoi.set_crs(4326)
+    st.session_state.bbox = [float(v) for v in gdf_aoi.to_crs(4326).total_bounds]
+    # Kept as LV95 WKT so the query (and later syncs) select tiles on the geometries
+    st.session_state.aoi_wkt = shapely.GeometryCollection(list(gdf_aoi.to_crs(2056).geometry)).wkt
 
 if 'bbox' in st.session_state:
     st.write(f"Selected bounding box (WGS84): {st.session_state.bbox}")
@@ -264,27 +480,66 @@ if 'bbox' in st.session_state:
         bbox_wgs84, bbox_lv95 = bbox_results
         st.write(f"Converted bounding box (LV95): {bbox_lv95}")
         
+        query = {
+            'bbox_wgs84': list(bbox_wgs84), 'bbox_lv95': list(bbox_lv95),
+            'mnt': mnt, 'mns': mns, 'bati3D_v2': bati3D_v2, 'bati3D_v3': bati3D_v3, 'ortho': ortho,
+            'mnt_resol': mnt_resol, 'ortho_resol': ortho_resol, 'use_grid': use_grid, 'clip': clip, 'mosaic': mosaic,
+            'aoi_wkt': st.session_state.get('aoi_wkt'),
+        }
+
         if st.button("Get Download Links"):
             with st.spinner("Fetching download links..."):
-                urls = get_urls(bbox_wgs84, mnt, mns, bati3D_v2, bati3D_v3, ortho, mnt_resol, ortho_resol)
-                if urls:
-                    st.success(f"Found {len(urls)} files to download:")
+                urls = list_urls(query)
+                # Kept across reruns: the Download button below triggers a new run of the script
+                st.session_state.links = {'query': query, 'urls': urls, 'plan': preflight(urls) if urls else None}
+
+        links = st.session_state.get('links')
+        if links is not None and links['query'] != query:
+            st.info("The selection changed since the links were fetched; click 'Get Download Links' again.")
+        elif links is not None:
+            urls, plan = links['urls'], links['plan']
+            if urls:
+                st.success(f"Found {len(urls)} files to download:")
+                with st.expander("Files"):
                     for url in urls:
                         st.write(url)
-                    
-                    if st.button("Download Files"):
-                        with st.spinner("Downloading files..."):
-                            download_path = download_files(urls, "downloads")
-                            st.success(f"Files downloaded to: {download_path}")
-                else:
-                    st.warning("No files found for the selected area and options.")
-        
+
+                show_preflight(plan)
+                batches = plan['batches']
+                if not batches:
+                    st.error(f"This job exceeds the budget of {format_bytes(JOB_MAX_BYTES)}; reduce the area or the products.")
+                elif len(batches) > 1:
+                    st.warning(f"This job exceeds the budget of {format_bytes(JOB_MAX_BYTES)} and is split into {len(batches)} batches.")
+
+                batch = 0
+                if len(batches) > 1:
+                    batch = st.selectbox("Batch to download", range(len(batches)), format_func=lambda i: f"Batch {i + 1} ({len(batches[i])} files)")
+                if batches and st.button("Download Files"):
+                    bar = st.progress(0.0)
+                    status = st.empty()
+                    callback = show_download_progress(bar, status)
+                    batch_query = query
+                    if len(batches) > 1:
+                        # A later sync only updates the tiles of this batch, within the budget
+                        batch_query = dict(query, scope=batch_scope(batches[batch]))
+                    download_path, failed = download_files(batches[batch], "downloads", max_workers, callback, batch_query)
+                    remember_throughput(callback)
+                    for r in failed:
+                        st.warning(f"Failed to download {r['url']}: {r['error']}")
+                    if failed:
+                        st.warning(f"The job in {download_path} is incomplete; it can be resumed below.")
+                    else:
+                        st.success(f"Files downloaded to: {download_path}")
+            else:
+                st.warning("No files found for the selected area and options.")
+
        # Option to download forest data
 if st.button("Download Forest Data"):
     with st.spinner("Downloading forest data..."):
-        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.geojson') as tmp:
-            geojson_forest(bbox_lv95, tmp.name)
-            gdf = gpd.read_file(tmp.name)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fn_forest = os.path.join(tmpdir, 'forest.gpkg')
+            geojson_forest(bbox_lv95, fn_forest)
+            gdf = gpd.read_file(fn_forest)
             st.write(gdf)
             
             # Display the forest data on a map
@@ -299,13 +554,201 @@ if st.button("Download Forest Data"):
                 file_name="forest_data.geojson",
                 mime="application/json"
             )
-            
-            os.unlink(tmp.name)
+            with open(fn_forest, 'rb') as f:
+                st.download_button(
+                    label="Download Forest GeoPackage",
+                    data=f.read(),
+                    file_name="forest_data.gpkg",
+                    mime="application/geopackage+sqlite3"
+                )
+
         st.success("Forest data downloaded, displayed, and available for download.")
 
 else:
     st.error("Selected area is outside Switzerland. Please select an area within Switzerland.")
 
+# Jobs interrupted by a crash, a restart or a rerun of the page
+interrupted = unfinished_jobs("downloads")
+if interrupted:
+    st.subheader("Resume an Interrupted Extraction")
+    job_path = st.selectbox("Interrupted extraction", interrupted, format_func=lambda p: p.name)
+    job = load_job(job_path)
+    st.write(f"{len(job['done'])}/{len(job['urls'])} files done, {len(job['failed'])} failed")
+    if st.button("Resume Extraction"):
+        bar = st.progress(0.0)
+        status = st.empty()
+        callback = show_download_progress(bar, status)
+        try:
+            download_path, failed = run_job(job_path, max_workers, callback)
+        except RuntimeError as e:
+            st.error(str(e))
+        else:
+            remember_throughput(callback)
+            for r in failed:
+                st.warning(f"Failed to download {r['url']}: {r['error']}")
+            if not failed:
+                st.success(f"Extraction completed: {download_path}")
+
+# Incremental sync of a previous extraction
+st.subheader("Sync an Existing Extraction")
+extractions = find_extractions("downloads")
+if extractions:
+    extraction = st.selectbox("Extraction", extractions, format_func=lambda p: p.name)
+    prune = st.checkbox("Remove assets no longer listed (e.g. superseded swissimage years)", value=True)
+    if st.button("Sync Extraction"):
+        bar = st.progress(0.0)
+        status = st.empty()
+        callback = show_download_progress(bar, status)
+        new, changed, removed, failed = sync_files(extraction, max_workers, callback, prune)
+        remember_throughput(callback)
+        for r in failed:
+            st.warning(f"Failed to download {r['url']}: {r['error']}")
+        st.success(f"{extraction.name}: {len(new)} new, {len(changed)} changed, {len(removed)} no longer listed")
+else:
+    st.info("No previous extraction with a manifest found in 'downloads'.")
+
+# Post-processing of an extraction
+st.subheader("Process an Extraction")
+if extractions:
+    extraction_pp = st.selectbox("Extraction to process", extractions, format_func=lambda p: p.name, key="extraction_pp")
+
+    with st.expander("Terrain derivatives (hillshade, slope, aspect, roughness)"):
+        dems = extraction_rasters(extraction_pp, 'swissalti3d')
+        if dems:
+            dem = st.selectbox("Terrain model (MNT)", dems, format_func=lambda p: p.name)
+            products = st.multiselect("Derivatives", list(DERIVATIVES), default=list(DERIVATIVES))
+            if st.button("Compute Derivatives") and products:
+                with st.spinner("Computing terrain derivatives..."):
+                    paths = compute_derivatives(dem, extraction_pp / 'derivatives', products)
+                st.success(f"Derivatives written: {', '.join(p.name for p in paths.values())}")
+        else:
+            st.info("No MNT mosaic (.vrt) or clipped MNT found in this extraction.")
+
+    with st.expander("Terrain mesh (3D Tiles, adaptive triangulation)"):
+        dems = extraction_rasters(extraction_pp, 'swissalti3d')
+        if dems:
+            dem = st.selectbox("Terrain model (MNT)", dems, format_func=lambda p: p.name, key="terrain_mnt")
+            max_error = st.number_input("Maximum vertical error (m)", min_value=0.05, max_value=10.0, value=TERRAIN_MAX_ERROR, step=0.05)
+            if st.button("Build Terrain Tiles"):
+                try:
+                    with st.spinner("Triangulating terrain tiles..."):
+                        tileset, n_triangles = build_terrain(dem, extraction_pp / '3dtiles' / f"{dem.stem}_terrain", max_error)
+                except ValueError as e:
+                    st.error(f"No terrain tiles written: {e}")
+                else:
+                    st.success(f"Tileset written: {tileset} ({n_triangles:,} triangles at full detail)")
+        else:
+            st.info("No MNT mosaic (.vrt) or clipped MNT found in this extraction.")
+
+    with st.expander("Canopy height (nDSM = MNS - MNT) and canopy mask"):
+        dems = extraction_rasters(extraction_pp, 'swissalti3d')
+        surfaces = extraction_rasters(extraction_pp, 'swisssurface3d-raster')
+        if dems and surfaces:
+            col1, col2 = st.columns(2)
+            with col1:
+                dem = st.selectbox("Terrain model (MNT)", dems, format_func=lambda p: p.name, key="canopy_mnt")
+            with col2:
+                surface = st.selectbox("Surface model (MNS)", surfaces, format_func=lambda p: p.name, key="canopy_mns")
+            threshold = st.slider("Canopy height threshold (m)", 1.0, 10.0, CANOPY_THRESHOLD, 0.5)
+            in_forest = st.checkbox("Restrict the canopy mask to TLM forest polygons", value=True)
+            if st.button("Compute Canopy"):
+                with st.spinner("Computing canopy height and mask..."):
+                    forest = None
+                    if in_forest:
+                        forest = extraction_pp / 'forest.gpkg'
+                        if not forest.exists():
+                            geojson_forest(load_manifest(extraction_pp)['query']['bbox_lv95'], forest)
+                    paths = compute_canopy(dem, surface, extraction_pp / 'canopy', forest, threshold)
+                st.success(f"Canopy written: {', '.join(p.name for p in paths.values())}")
+        else:
+            st.info("This extraction needs both an MNT and an MNS mosaic (.vrt) or clipped raster.")
+
+    with st.expander("3D buildings to GeoParquet (clipped to the extraction area)"):
+        if any(p.is_dir() and p.name.startswith('swissbuildings3d') for p in extraction_pp.iterdir()):
+            if st.button("Convert Buildings"):
+                with st.spinner("Converting swissBUILDINGS3D archives..."):
+                    converted = convert_buildings(extraction_pp)
+                for product, paths in converted.items():
+                    st.write(f"{product}: " + ', '.join(f"{layer} ({len(read_buildings(p, columns=[]))} features)" for layer, p in paths.items()))
+                st.success("GeoParquet written next to the archives; bbox reads only touch the matching row groups.")
+        else:
+            st.info("No swissBUILDINGS3D archives in this extraction.")
+
+    with st.expander("3D building tiles (glTF with levels of detail, 3D Tiles)"):
+        layers = sorted(extraction_pp.glob('swissbuildings3d*_parquet/*.parquet'))
+        if layers:
+            layer = st.selectbox("Converted buildings layer", layers, format_func=lambda p: f"{p.parent.name} / {p.stem}")
+            max_buildings = st.number_input("Buildings per tile", min_value=100, max_value=10000, value=MAX_BUILDINGS_PER_TILE, step=100)
+            if st.button("Build 3D Tiles"):
+                try:
+                    with st.spinner("Triangulating buildings and writing tiles..."):
+                        tileset = build_tileset(read_buildings(layer), extraction_pp / '3dtiles' / f"{layer.parent.name}_{layer.stem}", max_buildings)
+                except ValueError as e:
+                    st.error(f"No building tiles written: {e}")
+                else:
+                    st.success(f"Tileset written: {tileset}")
+        else:
+            st.info("Convert the 3D buildings to GeoParquet first.")
+
+    with st.expander("Zonal statistics (elevation and canopy height per polygon)"):
+        candidates = extraction_rasters(extraction_pp, 'swissalti3d') + extraction_rasters(extraction_pp, 'swisssurface3d-raster')
+        if (extraction_pp / 'canopy' / 'ndsm.tif').exists():
+            candidates.append(extraction_pp / 'canopy' / 'ndsm.tif')
+        if candidates:
+            zones_source = st.radio("Zones", ["TLM forest polygons", "Uploaded polygons"], horizontal=True)
+            zones_file = None
+            if zones_source == "Uploaded polygons":
+                zones_file = st.file_uploader("Polygons (GeoJSON, GeoPackage)", type=["geojson", "json", "gpkg"], key="zones_file")
+            selected = st.multiselect("Rasters", candidates, default=candidates, format_func=lambda p: p.name)
+            stats = st.multiselect("Statistics", ['count', 'mean', 'min', 'max', 'p10', 'p50', 'p90'], default=list(ZONAL_STATS))
+            if st.button("Compute Zonal Statistics") and selected and stats:
+                with st.spinner("Computing zonal statistics..."):
+                    if zones_file is not None:
+                        zones = gpd.read_file(zones_file)
+                    else:
+                        fn_forest = extraction_pp / 'forest.gpkg'
+                        if not fn_forest.exists():
+                            geojson_forest(load_manifest(extraction_pp)['query']['bbox_lv95'], fn_forest)
+                        zones = gpd.read_file(fn_forest)
+                    gdf = zonal_stats(zones, {p.stem: p for p in selected}, stats).to_crs(WGS84)
+                st.write(gdf.drop(columns='geometry'))
+                west, south, east, north = gdf.total_bounds
+                m = folium.Map(location=[(south + north) / 2, (west + east) / 2], zoom_start=13)
+                fields = [c for c in gdf.columns if c != 'geometry']
+                folium.GeoJson(gdf, tooltip=folium.GeoJsonTooltip(fields=fields)).add_to(m)
+                folium_static(m)
+                st.download_button(
+                    label="Download Zonal Statistics GeoJSON",
+                    data=gdf.to_json(),
+                    file_name=f"{extraction_pp.name}_zonal_stats.geojson",
+                    mime="application/json"
+                )
+        else:
+            st.info("No MNT, MNS or canopy height raster found in this extraction.")
+
+# Batch coordinate conversion
+with st.expander("Convert a CSV of coordinates (WGS84 <-> LV95)"):
+    csv_file = st.file_uploader("CSV file", type=["csv"])
+    if csv_file is not None:
+        df = pd.read_csv(csv_file)
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            x_col = st.selectbox("X column (lon / E)", df.columns, index=0)
+        with col2:
+            y_col = st.selectbox("Y column (lat / N)", df.columns, index=min(1, len(df.columns) - 1))
+        with col3:
+            direction = st.selectbox("Direction", ["WGS84 -> LV95", "LV95 -> WGS84"])
+        src, dst, out_cols = (WGS84, LV95, ('E', 'N')) if direction == "WGS84 -> LV95" else (LV95, WGS84, ('lon', 'lat'))
+        df[out_cols[0]], df[out_cols[1]] = transform_points(df[x_col].to_numpy(), df[y_col].to_numpy(), src, dst)
+        st.write(f"{len(df)} points converted")
+        st.dataframe(df.head(100))
+        st.download_button(
+            label="Download converted CSV",
+            data=df.to_csv(index=False),
+            file_name="converted_coordinates.csv",
+            mime="text/csv"
+        )
+
 # Add information about the app in the sidebar
 st.sidebar.info("""
 This application allows you to download various types of geospatial data for Switzerland. 
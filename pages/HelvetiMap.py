@@ -2,20 +2,24 @@ import streamlit as st
 import folium
 from streamlit_folium import folium_static
 import geopandas as gpd
-import requests
 import json
 import os
 import tempfile
-import urllib.request
 from osgeo import gdal
 import numpy as np
-from shapely.geometry import box
 from branca.element import Template, MacroElement
-import time
 from requests.exceptions import RequestException
 import rasterio
 from rasterio.enums import Resampling
 import math
+import shapely
+
+from vertgis.catalog import get_items, lookup_assets, asset_checksum
+from vertgis.download import download_many, format_bytes, MAX_WORKERS
+from vertgis.grid import select_intersecting
+from vertgis.stac import PAGE_LIMIT
+from vertgis.cog import clip_to_cog
+from vertgis.gpkg import export_gpkg
 
 # Configuration de GDAL
 gdal.UseExceptions()
@@ -44,95 +48,90 @@ PAPER_FORMATS = {
     "A0": (841, 1189),
 }
 
-@st.cache_data
-def getitems(productname, LLlon, LLlat, URlon, URlat, first100=0, max_retries=3, retry_delay=1):
+def getitems(productname, LLlon, LLlat, URlon, URlat, first100=0):
     if any(math.isnan(coord) for coord in [LLlon, LLlat, URlon, URlat]):
         st.error("Coordonnées invalides pour la bounding box.")
         return [], 0
 
-    url = f"https://data.geo.admin.ch/api/stac/v0.9/collections/{productname}/items?bbox={LLlon},{LLlat},{URlon},{URlat}"
-    
-    for attempt in range(max_retries):
-        try:
-            itemsrequest = requests.get(url, timeout=30)
-            itemsrequest.raise_for_status()  # Raise an exception for bad status codes
-            
-            itemsresult = itemsrequest.json()
-            
-            assets = []
-            if 'features' in itemsresult:
-                for feature in itemsresult['features']:
-                    if 'assets' in feature:
-                        assets.extend(feature['assets'].values())
-            
-            morethan100 = 0
-            if 'links' in itemsresult:
-                next_link = next((link for link in itemsresult['links'] if link.get('rel') == 'next'), None)
-                if next_link:
-                    morethan100 = 1
-            
-            if morethan100 and first100 == 0:
-                while next_link:
-                    itemsrequest = requests.get(next_link['href'], timeout=30)
-                    itemsrequest.raise_for_status()
-                    itemsresult = itemsrequest.json()
-                    
-                    if 'features' in itemsresult:
-                        for feature in itemsresult['features']:
-                            if 'assets' in feature:
-                                assets.extend(feature['assets'].values())
-                    
-                    next_link = next((link for link in itemsresult.get('links', []) if link.get('rel') == 'next'), None)
-            
-            itemsfiles = [asset['href'] for asset in assets if 'href' in asset]
-            
-            # Filtrage spécifique pour certains produits
-            if "_krel_" in productname:
-                itemsfiles = [i for i in itemsfiles if "_krel_" in i]
-            elif "swissimage" in productname:
-                itemsfiles = [i for i in itemsfiles if "_0.1_" in i]
-            elif "swissalti3d" in productname:
-                itemsfiles = [i for i in itemsfiles if ".tif" in i and "_0.5_" in i]
-            
-            return itemsfiles, morethan100
-        
-        except RequestException as e:
-            if attempt < max_retries - 1:
-                st.warning(f"Erreur lors de la requête API (tentative {attempt + 1}/{max_retries}): {str(e)}. Nouvelle tentative dans {retry_delay} secondes...")
-                time.sleep(retry_delay)
-            else:
-                st.error(f"Erreur lors de la requête API après {max_retries} tentatives: {str(e)}")
-                return [], 0
-        
-        except json.JSONDecodeError:
-            st.error("Erreur lors du décodage de la réponse JSON")
-            return [], 0
-        
-        except Exception as e:
-            st.error(f"Une erreur inattendue s'est produite: {str(e)}")
-            return [], 0
-
-    st.error("Impossible de récupérer les données après plusieurs tentatives.")
-    return [], 0
-
-def download_file(url, output_path):
     try:
-        urllib.request.urlretrieve(url, output_path)
-        return True
+        # Catalogue local des items STAC ; les pages manquantes sont listées en parallèle,
+        # chacune avec ses propres tentatives
+        features = get_items(productname, (LLlon, LLlat, URlon, URlat))
+    except RequestException as e:
+        st.error(f"Erreur lors de la requête API : {str(e)}")
+        return [], 0
+    except json.JSONDecodeError:
+        st.error("Erreur lors du décodage de la réponse JSON")
+        return [], 0
     except Exception as e:
-        st.error(f"Erreur lors du téléchargement du fichier {url}: {str(e)}")
-        return False
-
-def merge_rasters(input_files, output_file):
-    vrt_options = gdal.BuildVRTOptions(resampleAlg='cubic', addAlpha=True)
-    vrt = gdal.BuildVRT("/vsimem/merged.vrt", input_files, options=vrt_options)
-    gdal.Translate(output_file, vrt, format="GTiff", creationOptions=[
-        "COMPRESS=LZW",
-        "PREDICTOR=2",
-        "BIGTIFF=YES",
-        "TILED=YES"
-    ])
-    vrt = None
+        st.error(f"Une erreur inattendue s'est produite: {str(e)}")
+        return [], 0
+
+    morethan100 = int(len(features) > PAGE_LIMIT)
+    if first100:
+        features = features[:PAGE_LIMIT]
+
+    assets = []
+    for feature in features:
+        if 'assets' in feature:
+            assets.extend(feature['assets'].values())
+
+    itemsfiles = [asset['href'] for asset in assets if 'href' in asset]
+
+    # Filtrage spécifique pour certains produits
+    if "_krel_" in productname:
+        itemsfiles = [i for i in itemsfiles if "_krel_" in i]
+    elif "swissimage" in productname:
+        itemsfiles = [i for i in itemsfiles if "_0.1_" in i]
+    elif "swissalti3d" in productname:
+        itemsfiles = [i for i in itemsfiles if ".tif" in i and "_0.5_" in i]
+
+    return itemsfiles, morethan100
+
+def download_layers(layer_items, temp_dir, max_workers=MAX_WORKERS, on_progress=None):
+    # Toutes les tuiles de toutes les couches sont téléchargées ensemble ; le hash est
+    # calculé pendant le téléchargement, un fichier corrompu est retéléchargé
+    jobs, job_layers = [], []
+    for layer, items in layer_items.items():
+        for i, url in enumerate(items):
+            jobs.append((url, os.path.join(temp_dir, f"{layer}_{i}.tif")))
+            job_layers.append(layer)
+    urls = [url for url, _ in jobs]
+    checksums = {url: asset_checksum(a) for url, a in lookup_assets(urls).items()}
+    results = download_many(jobs, max_workers, on_progress=on_progress, checksums=checksums)
+    # Fichiers téléchargés, regroupés par couche
+    files = {layer: [] for layer in layer_items}
+    for layer, r in zip(job_layers, results):
+        if r['ok']:
+            files[layer].append(str(r['path']))
+        elif r['verified'] is False:
+            st.error(f"Fichier corrompu, rejeté : {r['url']}")
+        else:
+            st.error(f"Erreur lors du téléchargement du fichier {r['url']}: {r['error']}")
+    return {layer: paths for layer, paths in files.items() if paths}
+
+def show_progress(bar, status):
+    # Barre globale et avancement des fichiers en cours
+    def callback(progress):
+        bar.progress(progress.fraction)
+        lines = [
+            f"{progress.done_files}/{progress.total_files} fichiers - "
+            f"{format_bytes(progress.bytes_done)} à {format_bytes(progress.rate)}/s"
+        ]
+        for url, (done, size) in progress.snapshot():
+            if size and done < size:
+                lines.append(f"- {os.path.basename(url)} : {done * 100 // size} %")
+        status.markdown("\n".join(lines))
+    return callback
+
+def merge_rasters(input_files, output_file, bbox, cutline=None, res=None):
+    # Découpe directe à l'emprise (ou aux géométries uploadées) en une passe,
+    # écrite en COG multi-thread avec overviews internes
+    clip_to_cog(input_files, output_file, bounds=bbox, cutline=cutline, res=res)
+
+def print_resolution(scale, dpi):
+    # Taille d'un pixel au sol (m) pour une impression à l'échelle 1:scale
+    return scale * 0.0254 / dpi
 
 def generate_preview(file_path, max_size=1000):
     with rasterio.open(file_path) as dataset:
@@ -150,8 +149,8 @@ def generate_preview(file_path, max_size=1000):
         )
 
         # Si l'image a plusieurs bandes, assurez-vous qu'elle est dans le bon ordre pour l'affichage
-        if data.shape[0] == 3:
-            preview = np.transpose(data, (1, 2, 0))
+        if data.shape[0] in (3, 4):
+            preview = np.transpose(data[:3], (1, 2, 0))
         else:
             preview = data[0]  # Prendre seulement la première bande si ce n'est pas une image RGB
         
@@ -274,6 +273,20 @@ def main():
 
         export_format = st.selectbox("Format d'export:", ["GeoTIFF", "GeoPackage"])
 
+        max_workers = st.slider("Téléchargements parallèles", 1, 16, MAX_WORKERS)
+
+        res = None
+        if st.checkbox("Rééchantillonner pour l'impression"):
+            paper_format = st.selectbox("Format papier:", list(PAPER_FORMATS.keys()), index=1)
+            scale = st.number_input("Échelle 1:", min_value=100, value=1000, step=100)
+            dpi = st.number_input("Résolution (DPI):", min_value=72, max_value=1200, value=300, step=50)
+            res = print_resolution(scale, dpi)
+            width, height = PAPER_FORMATS[paper_format]
+            st.caption(
+                f"{res:.3f} m/pixel - emprise {paper_format} au 1:{scale} : "
+                f"{width * scale / 1000:.0f} × {height * scale / 1000:.0f} m"
+            )
+
         if st.button("Générer le fond de plan"):
             bbox = None
             if uploaded_file is not None:
@@ -289,29 +302,36 @@ def main():
                 with st.spinner('Génération du fond de plan en cours...'):
                     try:
                         with tempfile.TemporaryDirectory() as temp_dir:
-                            downloaded_files = []
+                            layer_items = {}
                             for layer in selected_layers:
                                 product = LAYERS[layer]
                                 items, _ = getitems(product, bbox[0], bbox[1], bbox[2], bbox[3])
+                                if uploaded_file is not None:
+                                    # Seules les tuiles qui touchent les géométries uploadées
+                                    items = select_intersecting(items, shapely.GeometryCollection(list(gdf.to_crs(2056).geometry)))
                                 if not items:
                                     st.warning(f"Aucune donnée trouvée pour la couche {layer}")
                                     continue
-                                for i, item_url in enumerate(items):
-                                    file_path = os.path.join(temp_dir, f"{layer}_{i}.tif")
-                                    if download_file(item_url, file_path):
-                                        downloaded_files.append(file_path)
-                            
-                            if downloaded_files:
+                                layer_items[layer] = items
+
+                            callback = show_progress(st.progress(0.0), st.empty())
+                            layer_files = download_layers(layer_items, temp_dir, max_workers, callback)
+
+                            if layer_files:
+                                cutline = None
+                                if uploaded_file is not None:
+                                    cutline = os.path.join(temp_dir, "zone.geojson")
+                                    gdf.to_file(cutline, driver="GeoJSON")
                                 if export_format == "GeoTIFF":
                                     output_path = os.path.join(temp_dir, "fond_de_plan.tif")
-                                    merge_rasters(downloaded_files, output_path)
+                                    downloaded_files = [f for files in layer_files.values() for f in files]
+                                    merge_rasters(downloaded_files, output_path, bbox, cutline, res)
+                                    preview_path = output_path
                                 else:  # GeoPackage
+                                    # Une table raster tuilée par couche, écrite par blocs
                                     output_path = os.path.join(temp_dir, "fond_de_plan.gpkg")
-                                    gdf = gpd.GeoDataFrame({'geometry': [box(*bbox)]}, crs="EPSG:4326")
-                                    for file in downloaded_files:
-                                        with rasterio.open(file) as src:
-                                            gdf[os.path.basename(file)] = [src.read(1)]
-                                    gdf.to_file(output_path, driver="GPKG")
+                                    tables = export_gpkg(layer_files, output_path, bbox, cutline=cutline, res=res)
+                                    preview_path = f"GPKG:{output_path}:{next(iter(tables.values()))}"
 
                                 with open(output_path, "rb") as file:
                                     btn = st.download_button(
@@ -322,7 +342,7 @@ def main():
                                     )
                                 
                                 # Afficher un aperçu
-                                preview = generate_preview(output_path)
+                                preview = generate_preview(preview_path)
                                 st.image(preview, caption="Aperçu du fond de plan", use_column_width=True)
                             else:
                                 st.error("Aucune image n'a pu être récupérée. Veuillez vérifier votre sélection de couches et la zone d'intérêt.")
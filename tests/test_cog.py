@@ -0,0 +1,68 @@
+import json
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+pytest.importorskip('osgeo.gdal')
+
+from vertgis.cog import clip_to_cog, write_cog  # noqa: E402
+
+X0, Y0 = 2600000, 1200000
+
+
+def write_tiles(tmp_path):
+    # Two adjacent 600 x 600 m RGB tiles at 1 m
+    paths = []
+    for i in range(2):
+        path = tmp_path / f'tile_{i}.tif'
+        data = np.full((3, 600, 600), 50 + 100 * i, 'uint8')
+        with rasterio.open(path, 'w', driver='GTiff', width=600, height=600, count=3, dtype='uint8',
+                           crs='EPSG:2056', transform=from_origin(X0 + 600 * i, Y0 + 600, 1, 1)) as dst:
+            dst.write(data)
+        paths.append(path)
+    return paths
+
+
+def test_clip_to_cog_bounds(tmp_path):
+    out = tmp_path / 'out.tif'
+    clip_to_cog(write_tiles(tmp_path), out, bounds=(X0 + 100, Y0 + 50, X0 + 1100, Y0 + 550), bounds_srs='EPSG:2056')
+    with rasterio.open(out) as src:
+        assert src.tags(ns='IMAGE_STRUCTURE').get('LAYOUT') == 'COG'
+        assert (src.width, src.height, src.count) == (1000, 500, 4)
+        assert src.overviews(1)
+        data = src.read()
+    assert (data[0, :, :400] == 50).all() and (data[0, :, 600:] == 150).all()
+    assert (data[3] == 255).all()
+
+
+def test_clip_to_cog_cutline_and_resolution(tmp_path):
+    cutline = tmp_path / 'zone.geojson'
+    cutline.write_text(json.dumps({
+        'type': 'FeatureCollection',
+        'crs': {'type': 'name', 'properties': {'name': 'urn:ogc:def:crs:EPSG::2056'}},
+        'features': [{'type': 'Feature', 'properties': {}, 'geometry': {
+            'type': 'Polygon',
+            'coordinates': [[[X0 + 100, Y0 + 100], [X0 + 500, Y0 + 100], [X0 + 100, Y0 + 500], [X0 + 100, Y0 + 100]]],
+        }}],
+    }))
+    out = tmp_path / 'out.tif'
+    clip_to_cog(write_tiles(tmp_path), out, cutline=cutline, res=2)
+    with rasterio.open(out) as src:
+        assert (src.width, src.height) == (200, 200)
+        alpha = src.read(4)
+    # Transparent above the diagonal of the triangle
+    assert alpha[-1, 0] == 255 and alpha[0, -1] == 0
+
+
+def test_write_cog_float(tmp_path):
+    path = tmp_path / 'dem.tif'
+    data = np.random.default_rng(0).random((700, 700), dtype='float32')
+    with rasterio.open(path, 'w', driver='GTiff', width=700, height=700, count=1, dtype='float32',
+                       crs='EPSG:2056', transform=from_origin(X0, Y0, 0.5, 0.5)) as dst:
+        dst.write(data, 1)
+    write_cog(str(path), tmp_path / 'dem_cog.tif')
+    with rasterio.open(tmp_path / 'dem_cog.tif') as src:
+        assert src.tags(ns='IMAGE_STRUCTURE').get('LAYOUT') == 'COG'
+        assert (src.read(1) == data).all()
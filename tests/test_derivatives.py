@@ -0,0 +1,47 @@
+import warnings
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from vertgis.derivatives import compute_block, compute_derivatives, NODATA
+
+
+def write_dem(path, z, nodata=-9999.0):
+    profile = dict(driver='GTiff', width=z.shape[1], height=z.shape[0], count=1, dtype='float32',
+                   crs='EPSG:2056', transform=from_origin(2600000, 1200000, 2, 2), nodata=nodata)
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(z, 1)
+
+
+def test_block_masks_nan_hole(tmp_path):
+    y, x = np.mgrid[0:16, 0:16]
+    z = (x * 3.0 + y * 2.0).astype('float32')
+    z[7:9, 7:9] = -9999.0
+    path = tmp_path / 'dem.tif'
+    write_dem(path, z)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        res = compute_block(str(path), ('hillshade', 'slope', 'aspect', 'roughness'), Window(0, 0, 16, 16))
+    # The hole and its 8-neighbourhood are nodata, everything else is valid
+    expected = np.zeros((16, 16), bool)
+    expected[6:10, 6:10] = True
+    assert ((res['valid'] == 0) == expected).all()
+    for product in ('slope', 'aspect', 'roughness'):
+        assert not np.isnan(res[product]).any()
+        assert ((res[product] == NODATA) == expected).all()
+    assert (res['hillshade'][~expected] > 0).all()
+
+
+def test_hillshade_mask_band(tmp_path):
+    z = np.full((32, 32), 100.0, dtype='float32')
+    z[10, 10] = -9999.0
+    path = tmp_path / 'dem.tif'
+    write_dem(path, z)
+    paths = compute_derivatives(path, tmp_path / 'out', ('hillshade',), max_workers=1)
+    with rasterio.open(paths['hillshade']) as src:
+        assert src.nodata is None
+        mask = src.read_masks(1)
+    assert (mask[9:12, 9:12] == 0).all()
+    assert (mask == 0).sum() == 9
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+pytest.importorskip('osgeo.gdal')
+
+from vertgis.gpkg import export_gpkg, table_name  # noqa: E402
+
+X0, Y0 = 2600000, 1200000
+
+
+def write_tile(path, value):
+    with rasterio.open(path, 'w', driver='GTiff', width=1000, height=1000, count=3, dtype='uint8',
+                       crs='EPSG:2056', transform=from_origin(X0, Y0 + 1000, 1, 1)) as dst:
+        dst.write(np.full((3, 1000, 1000), value, 'uint8'))
+    return path
+
+
+def test_table_name():
+    assert table_name('Végétation') == 'vegetation'
+    assert table_name('Swissimage 10cm') == 'swissimage_10cm'
+    assert table_name('10 x') == 't_10_x'
+
+
+def test_export_gpkg_tables_and_overviews(tmp_path):
+    layers = {
+        'Végétation': [write_tile(tmp_path / 'a.tif', 60)],
+        'vegetation': [write_tile(tmp_path / 'b.tif', 120)],
+    }
+    out = tmp_path / 'plan.gpkg'
+    tables = export_gpkg(layers, out, bounds=(X0, Y0, X0 + 800, Y0 + 600), bounds_srs='EPSG:2056')
+    assert tables == {'Végétation': 'vegetation', 'vegetation': 'vegetation_2'}
+    for (name, table), value in zip(tables.items(), (60, 120)):
+        with rasterio.open(f'GPKG:{out}:{table}') as src:
+            assert (src.width, src.height) == (800, 600)
+            assert src.overviews(1) == [2]
+            assert (src.read(1, window=((0, 10), (0, 10))) == value).all()
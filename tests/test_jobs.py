@@ -0,0 +1,29 @@
+import os
+import time
+
+from vertgis import jobs
+
+
+def test_unfinished_skips_running_jobs(tmp_path):
+    path = tmp_path / 'extraction'
+    path.mkdir()
+    jobs.create(path, {}, ['http://example.com/a.tif'])
+    # Just written: may still be running
+    assert jobs.unfinished(tmp_path) == []
+    old = time.time() - 2 * jobs.ACTIVE_AGE
+    os.utime(path / jobs.JOURNAL_NAME, (old, old))
+    assert jobs.unfinished(tmp_path) == [path]
+    held = jobs.lock(path)
+    assert jobs.lock(path) is None
+    assert jobs.unfinished(tmp_path) == []
+    held.close()
+    assert jobs.unfinished(tmp_path) == [path]
+
+
+def test_load_ignores_a_torn_line(tmp_path):
+    jobs.create(tmp_path, {'a': 1}, ['u1', 'u2'])
+    with open(tmp_path / jobs.JOURNAL_NAME, 'a') as f:
+        f.write('{"event": "asse')
+    jobs.finish(tmp_path)
+    job = jobs.load(tmp_path)
+    assert job['finished'] and jobs.pending(job) == ['u1', 'u2']
@@ -0,0 +1,94 @@
+import functools
+import hashlib
+import http.server
+import threading
+
+import pytest
+
+from vertgis.download import download_many
+from vertgis.store import assemble, object_key, _lock
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / 'srv'
+    root.mkdir()
+    (root / 'a.bin').write_bytes(b'a' * 100_000)
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(root))
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+
+
+def test_assemble_duplicate_urls_and_store_hits(server, tmp_path):
+    url = f'{server}/a.bin'
+    checksums = {url: '1220' + hashlib.sha256(b'a' * 100_000).hexdigest()}
+    out = tmp_path / 'out'
+    out.mkdir()
+    jobs = [(url, out / 'a1.bin'), (url, out / 'a2.bin')]
+    seen = []
+    results = assemble(jobs, checksums, root=tmp_path / 'store', on_result=seen.append)
+    assert [r['ok'] for r in results] == [True, True]
+    assert [r['path'] for r in results] == [out / 'a1.bin', out / 'a2.bin']
+    assert all(r['verified'] is True and not r['cached'] for r in results)
+    assert len(seen) == 2
+    assert (out / 'a2.bin').read_bytes() == b'a' * 100_000
+
+    again = assemble([(url, out / 'a3.bin')], checksums, root=tmp_path / 'store')
+    assert again[0]['cached'] and again[0]['verified'] is True
+
+
+def test_assemble_reuses_complete_staged_files(server, tmp_path):
+    url = f'{server}/a.bin'
+    data = b'a' * 100_000
+    checksums = {url: '1220' + hashlib.sha256(data).hexdigest()}
+    root = tmp_path / 'store'
+    staged = root / 'staging' / object_key(url, checksums[url])
+    staged.parent.mkdir(parents=True)
+    # A corrupt staged file is fetched again, a good one is reused as is
+    staged.write_bytes(b'b' * 100_000)
+    out = tmp_path / 'out'
+    out.mkdir()
+    assert assemble([(url, out / 'a.bin')], checksums, root=root)[0]['verified'] is True
+    assert (out / 'a.bin').read_bytes() == data
+
+    # Without a checksum, a complete staged file is trusted
+    missing_url = f'{server}/gone.bin'
+    results = assemble([(missing_url, out / 'b.bin')], root=root)
+    assert not results[0]['ok']
+    staged_gone = root / 'staging' / object_key(missing_url)
+    staged_gone.write_bytes(b'c')
+    results = assemble([(missing_url, out / 'b.bin')], root=root)
+    assert results[0]['ok'] and (out / 'b.bin').read_bytes() == b'c'
+
+
+def test_download_many_cancels_queued_jobs_when_a_callback_raises(server, tmp_path):
+    jobs = [(f'{server}/a.bin', tmp_path / f'{i}.bin') for i in range(50)]
+
+    def stop(result):
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        download_many(jobs, max_workers=1, on_result=stop)
+    assert len(list(tmp_path.glob('*.bin'))) < 50
+
+
+def test_assemble_waits_for_an_object_another_session_downloads(server, tmp_path):
+    url = f'{server}/a.bin'
+    root = tmp_path / 'store'
+    (root / 'staging').mkdir(parents=True)
+    staged = root / 'staging' / object_key(url)
+    lock = _lock(staged)
+    out = tmp_path / 'out'
+    out.mkdir()
+    results = []
+    thread = threading.Thread(target=lambda: results.extend(assemble([(url, out / 'a.bin')], root=root)))
+    thread.start()
+    thread.join(0.5)
+    assert thread.is_alive()
+    # The other session finishes its download and releases the object
+    staged.write_bytes(b'z' * 10)
+    lock.close()
+    thread.join()
+    assert results[0]['ok'] and (out / 'a.bin').read_bytes() == b'z' * 10
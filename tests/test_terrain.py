@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from vertgis.terrain import build_terrain
+
+
+def write_dem(path, z):
+    with rasterio.open(path, 'w', driver='GTiff', width=z.shape[1], height=z.shape[0], count=1, dtype='float32',
+                       crs='EPSG:2056', transform=from_origin(2600000, 1200000, 2, 2), nodata=-9999.0) as dst:
+        dst.write(z, 1)
+
+
+def test_build_terrain(tmp_path):
+    y, x = np.mgrid[0:300, 0:300]
+    write_dem(tmp_path / 'dem.tif', (500 + np.sin(x / 20) * 10 + y * 0.1).astype('float32'))
+    tileset, n_triangles = build_terrain(tmp_path / 'dem.tif', tmp_path / 'tiles', max_workers=1)
+    assert tileset.exists() and n_triangles > 0
+
+
+def test_build_terrain_all_nodata(tmp_path):
+    write_dem(tmp_path / 'dem.tif', np.full((300, 300), -9999.0, 'float32'))
+    with pytest.raises(ValueError, match='no data'):
+        build_terrain(tmp_path / 'dem.tif', tmp_path / 'tiles', max_workers=1)
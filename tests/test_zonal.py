@@ -0,0 +1,44 @@
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+from vertgis.zonal import zonal_stats, overlap_layers
+
+
+def write_raster(path, data, transform, nodata=None):
+    profile = dict(driver='GTiff', width=data.shape[1], height=data.shape[0], count=1, dtype=data.dtype,
+                   crs='EPSG:2056', transform=transform, nodata=nodata)
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(data, 1)
+
+
+def test_overlapping_zones_keep_their_pixels(tmp_path):
+    path = tmp_path / 'values.tif'
+    write_raster(path, np.ones((100, 100), 'float32'), from_origin(0, 100, 1, 1))
+    zones = gpd.GeoDataFrame(geometry=[box(10, 10, 50, 110 - 10), box(30, 20, 90, 80), box(50, 10, 90, 20)], crs=2056)
+    res = zonal_stats(zones, {'v': path}, ('count', 'mean'), block=32, max_workers=1)
+    assert list(res['v_count']) == [40 * 90, 60 * 60, 40 * 10]
+    assert (res['v_mean'] == 1).all()
+
+
+def test_pixels_outside_the_raster_are_not_counted(tmp_path):
+    # The second rasters, without nodata value, only cover part of the zone:
+    # their missing pixels must not be counted as zeros
+    write_raster(tmp_path / 'ref.tif', np.ones((40, 40), 'float32'), from_origin(0, 40, 1, 1))
+    write_raster(tmp_path / 'aligned.tif', np.full((20, 20), 5, 'uint8'), from_origin(0, 20, 1, 1))
+    write_raster(tmp_path / 'shifted.tif', np.full((20, 20), 5, 'uint8'), from_origin(0.5, 20.5, 1, 1))
+    rasters = {name: tmp_path / f'{name}.tif' for name in ('ref', 'aligned', 'shifted')}
+    zones = gpd.GeoDataFrame(geometry=[box(0, 0, 30, 30)], crs=2056)
+    res = zonal_stats(zones, rasters, ('count', 'min'), max_workers=1)
+    assert res['ref_count'][0] == 900
+    assert res['aligned_count'][0] == 400
+    assert res['aligned_min'][0] == 5
+    assert 380 <= res['shifted_count'][0] <= 400
+    assert res['shifted_min'][0] == 5
+
+
+def test_touching_zones_share_a_layer():
+    geoms = np.array([box(0, 0, 1, 1), box(1, 0, 2, 1), box(0.5, 0, 1.5, 1)])
+    assert list(overlap_layers(geoms)) == [0, 0, 1]
@@ -0,0 +1 @@
+# Shared helpers for the VertGIS pages (swisstopo data access and processing).
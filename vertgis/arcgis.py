@@ -0,0 +1,145 @@
+"""Streaming client for ArcGIS FeatureServer layers.
+
+A single query is silently truncated at the layer's ``maxRecordCount``. The
+envelope is therefore split into sub-envelopes until each holds a bounded
+number of features, every sub-envelope is paged with ``resultOffset``, and
+all pages are fetched concurrently. Features on the seams are deduplicated
+on their object ID and written to a GeoPackage as the pages arrive.
+"""
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import fiona
+from fiona.crs import CRS
+
+from vertgis.net import make_session, TIMEOUT
+
+MAX_FEATURES_PER_ENVELOPE = 10000
+MAX_DEPTH = 6
+
+
+def layer_info(session, url_layer):
+    r = session.get(url_layer, params={'f': 'json'}, timeout=TIMEOUT)
+    r.raise_for_status()
+    info = r.json()
+    return {
+        'max_records': info.get('maxRecordCount') or 1000,
+        'oid_field': info.get('objectIdField') or 'OBJECTID',
+    }
+
+
+def _query(session, url_layer, params):
+    r = session.get(url_layer + '/query', params=params, timeout=TIMEOUT)
+    r.raise_for_status()
+    data = r.json()
+    if 'error' in data:
+        raise RuntimeError(f"ArcGIS error: {data['error'].get('message')}")
+    return data
+
+
+def envelope_params(params, envelope):
+    xmin, ymin, xmax, ymax = envelope
+    return dict(
+        params,
+        geometry=f'{xmin},{ymin},{xmax},{ymax}',
+        geometryType='esriGeometryEnvelope',
+        spatialRel='esriSpatialRelIntersects',
+    )
+
+
+def count(session, url_layer, params, envelope):
+    p = envelope_params(params, envelope)
+    p.update(returnCountOnly='true', f='json')
+    return _query(session, url_layer, p)['count']
+
+
+def split(envelope):
+    xmin, ymin, xmax, ymax = envelope
+    xmid, ymid = (xmin + xmax) / 2, (ymin + ymax) / 2
+    return [(xmin, ymin, xmid, ymid), (xmid, ymin, xmax, ymid), (xmin, ymid, xmid, ymax), (xmid, ymid, xmax, ymax)]
+
+
+def plan_envelopes(session, url_layer, params, envelope, pool, max_features=MAX_FEATURES_PER_ENVELOPE):
+    """Split ``envelope`` until each part holds at most ``max_features``.
+
+    Returns ``[(envelope, count), ...]``; counts of one level are queried
+    concurrently.
+    """
+    res = []
+    level = [envelope]
+    for depth in range(MAX_DEPTH + 1):
+        counts = pool.map(lambda env: count(session, url_layer, params, env), level)
+        next_level = []
+        for env, n in zip(level, counts):
+            if n == 0:
+                continue
+            if n > max_features and depth < MAX_DEPTH:
+                next_level += split(env)
+            else:
+                res.append((env, n))
+        if not next_level:
+            break
+        level = next_level
+    return res
+
+
+def _page(session, url_layer, params, envelope, offset, page_size, oid_field):
+    p = envelope_params(params, envelope)
+    p.update(
+        resultOffset=offset,
+        resultRecordCount=page_size,
+        orderByFields=oid_field,  # stable order, required for paging
+        f='geojson',
+    )
+    return _query(session, url_layer, p).get('features', [])
+
+
+def iter_features(url_layer, params, envelope, max_workers=8, session=None):
+    """Yield the GeoJSON features of ``url_layer`` matching ``params`` in ``envelope``, once each."""
+    session = session or make_session(pool_size=max_workers)
+    info = layer_info(session, url_layer)
+    page_size, oid_field = info['max_records'], info['oid_field']
+    seen = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        parts = plan_envelopes(session, url_layer, params, envelope, pool)
+        pages = ((env, offset) for env, n in parts for offset in range(0, n, page_size))
+        pending = set()
+
+        def submit_next():
+            for env, offset in pages:
+                pending.add(pool.submit(_page, session, url_layer, params, env, offset, page_size, oid_field))
+                return
+
+        # Only a bounded number of pages is held in memory at any time
+        for _ in range(2 * max_workers):
+            submit_next()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                pending.discard(fut)
+                submit_next()
+                for feature in fut.result():
+                    oid = feature.get('id', feature.get('properties', {}).get(oid_field))
+                    if oid in seen:
+                        continue
+                    seen.add(oid)
+                    yield feature
+
+
+def _as_multipolygon(geometry):
+    if geometry and geometry['type'] == 'Polygon':
+        return {'type': 'MultiPolygon', 'coordinates': [geometry['coordinates']]}
+    return geometry
+
+
+def features_to_gpkg(features, fn, properties, crs='EPSG:2056', layer=None, geometry_type='3D MultiPolygon'):
+    """Stream polygon features into a GeoPackage; returns the number written."""
+    schema = {'geometry': geometry_type, 'properties': properties}
+    n = 0
+    with fiona.open(fn, 'w', driver='GPKG', schema=schema, crs=CRS.from_user_input(crs), layer=layer) as dst:
+        for feature in features:
+            dst.write({
+                'geometry': _as_multipolygon(feature['geometry']),
+                'properties': {k: feature['properties'].get(k) for k in properties},
+            })
+            n += 1
+    return n
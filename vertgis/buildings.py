@@ -0,0 +1,95 @@
+"""swissBUILDINGS3D archives to spatially sorted GeoParquet.
+
+The archives (``.zip`` for v2, ``.gdb.zip`` for v3) are read in place
+through GDAL's ``/vsizip/`` without being extracted, with the AOI as spatial
+filter so that only the buildings touching it are decoded. All archives of a
+product are merged per layer, sorted along a Hilbert curve and written with
+a bbox covering column: each row group then holds a compact area, and
+``read_buildings(path, bbox)`` only reads the row groups overlapping
+``bbox``.
+"""
+import os
+import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import fiona
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+ROW_GROUP_SIZE = 5000
+DATASET_EXTENSIONS = ('.gdb', '.dxf', '.dwg', '.shp', '.gpkg')
+
+
+def archive_datasets(path):
+    """GDAL paths of the vector datasets inside the archive ``path``."""
+    with zipfile.ZipFile(path) as zf:
+        names = zf.namelist()
+    datasets = set()
+    for name in names:
+        parts = name.split('/')
+        for i, part in enumerate(parts):
+            if part.lower().endswith(DATASET_EXTENSIONS) and (part.lower().endswith('.gdb') or i == len(parts) - 1):
+                datasets.add('/'.join(parts[:i + 1]))
+                break
+    return [f'/vsizip/{path}/{name}' for name in sorted(datasets)]
+
+
+def read_archive(path, aoi_wkt):
+    """{layer: GeoDataFrame} of the features of ``path`` touching the AOI."""
+    aoi = shapely.from_wkt(aoi_wkt)
+    res = {}
+    for dataset in archive_datasets(path):
+        for layer in fiona.listlayers(dataset):
+            gdf = gpd.read_file(dataset, layer=layer, mask=aoi, engine='fiona')
+            if len(gdf):
+                res.setdefault(layer, []).append(gdf)
+    return {layer: pd.concat(lst, ignore_index=True) for layer, lst in res.items()}
+
+
+def sort_spatially(gdf):
+    # Neighbouring buildings end up in the same row groups
+    order = np.argsort(gdf.geometry.hilbert_distance(), kind='stable')
+    return gdf.iloc[order].reset_index(drop=True)
+
+
+def _file_name(layer):
+    return re.sub(r'[^\w-]+', '_', layer) + '.parquet'
+
+
+def convert(archives, out_dir, aoi, max_workers=None, row_group_size=ROW_GROUP_SIZE):
+    """Write one GeoParquet per layer of ``archives`` clipped to ``aoi`` (LV95).
+
+    Buildings are kept whole when they touch the AOI. Returns {layer: path}.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    archives = [str(a) for a in archives]
+    if not archives:
+        return {}
+    max_workers = min(max_workers or os.cpu_count() or 1, len(archives))
+    layers = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        for res in pool.map(partial(read_archive, aoi_wkt=shapely.to_wkt(aoi)), archives):
+            for layer, gdf in res.items():
+                layers.setdefault(layer, []).append(gdf)
+
+    paths = {}
+    for layer, lst in layers.items():
+        gdf = pd.concat(lst, ignore_index=True)
+        if 'UUID' in gdf.columns:
+            # A building crossing a tile edge may be delivered with both tiles
+            gdf = gdf.drop_duplicates(subset='UUID')
+        path = out_dir / _file_name(layer)
+        sort_spatially(gdf).to_parquet(path, write_covering_bbox=True, row_group_size=row_group_size)
+        paths[layer] = path
+    return paths
+
+
+def read_buildings(path, bbox=None, columns=None):
+    """Read a converted layer, only touching the row groups overlapping ``bbox``."""
+    return gpd.read_parquet(path, bbox=bbox, columns=columns)
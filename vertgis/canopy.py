@@ -0,0 +1,137 @@
+"""Canopy height (nDSM) and canopy mask from swissSURFACE3D and swissALTI3D.
+
+The MNS is warped on the fly onto the MNT grid, and each block computes
+``nDSM = MNS - MNT``, thresholds it into a canopy mask (optionally restricted
+to TLM forest polygons) and vectorizes the mask. Polygons inside a block are
+written straight away; those touching a block edge are merged across the
+seams at the end.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import fiona
+import numpy as np
+import rasterio
+import shapely
+from fiona.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.features import rasterize, shapes
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import bounds as window_bounds, transform as window_transform
+from shapely.geometry import shape, mapping
+
+from vertgis.windows import BLOCK_SIZE, iter_windows, bounded_map
+
+NODATA = -9999.0
+CANOPY_THRESHOLD = 3.0
+MIN_AREA = 5.0
+# 0 is "no canopy", so pixels without data are marked apart
+MASK_NODATA = 255
+
+_cache = {}
+
+
+def _sources(mnt, mns, forest):
+    key = (mnt, mns, forest)
+    if key not in _cache:
+        src_mnt = rasterio.open(mnt)
+        src_mns = WarpedVRT(
+            rasterio.open(mns),
+            crs=src_mnt.crs,
+            transform=src_mnt.transform,
+            width=src_mnt.width,
+            height=src_mnt.height,
+            resampling=Resampling.bilinear,
+        )
+        tree = geoms = None
+        if forest:
+            with fiona.open(forest) as f:
+                geoms = np.array([shapely.force_2d(shape(feat['geometry'])) for feat in f if feat['geometry']])
+            tree = shapely.STRtree(geoms)
+        _cache[key] = (src_mnt, src_mns, tree, geoms)
+    return _cache[key]
+
+
+def _read(src, window):
+    data = src.read(1, window=window).astype('float32')
+    if src.nodata is not None:
+        data[data == src.nodata] = np.nan
+    return data
+
+
+def compute_block(mnt, mns, forest, threshold, window):
+    src_mnt, src_mns, tree, geoms = _sources(mnt, mns, forest)
+    ndsm = np.maximum(_read(src_mns, window) - _read(src_mnt, window), 0)
+    valid = ~np.isnan(ndsm)
+    mask = valid & (ndsm >= threshold)
+    transform = window_transform(window, src_mnt.transform)
+    if tree is not None:
+        hits = tree.query(shapely.box(*window_bounds(window, src_mnt.transform)))
+        if len(hits):
+            mask &= rasterize(geoms[hits], out_shape=mask.shape, transform=transform, dtype='uint8').astype(bool)
+        else:
+            mask[:] = False
+
+    # Block edges that are not raster edges: polygons touching them continue in the next block
+    left, bottom, right, top = window_bounds(window, src_mnt.transform)
+    r_left, r_bottom, r_right, r_top = src_mnt.bounds
+    inner, seams = [], []
+    for geom, _ in shapes(mask.astype('uint8'), mask=mask, transform=transform):
+        poly = shape(geom)
+        x0, y0, x1, y1 = poly.bounds
+        on_seam = (
+            (x0 <= left and left > r_left) or (x1 >= right and right < r_right)
+            or (y0 <= bottom and bottom > r_bottom) or (y1 >= top and top < r_top)
+        )
+        (seams if on_seam else inner).append(poly)
+    return np.where(valid, ndsm, NODATA).astype('float32'), np.where(valid, mask, MASK_NODATA).astype('uint8'), inner, seams
+
+
+def _raster_profile(profile, dtype, nodata):
+    return dict(
+        driver='GTiff', width=profile['width'], height=profile['height'], count=1,
+        crs=profile['crs'], transform=profile['transform'], dtype=dtype, nodata=nodata,
+        tiled=True, blockxsize=512, blockysize=512, compress='deflate', BIGTIFF='IF_SAFER',
+    )
+
+
+def compute_canopy(mnt, mns, out_dir, forest=None, threshold=CANOPY_THRESHOLD, min_area=MIN_AREA,
+                   block=BLOCK_SIZE, max_workers=None):
+    """Write ``ndsm.tif``, ``canopy_mask.tif`` and ``canopy.gpkg`` to ``out_dir``.
+
+    ``forest`` is an optional polygon file (e.g. the TLM forest GeoPackage)
+    the canopy mask is restricted to. Returns the three paths.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    max_workers = max_workers or os.cpu_count() or 1
+    paths = {'ndsm': out_dir / 'ndsm.tif', 'mask': out_dir / 'canopy_mask.tif', 'polygons': out_dir / 'canopy.gpkg'}
+    with rasterio.open(mnt) as src:
+        profile = src.profile
+        crs = src.crs
+        windows = list(iter_windows(src.width, src.height, block))
+
+    schema = {'geometry': 'Polygon', 'properties': {'area': 'float'}}
+    all_seams = []
+    with rasterio.open(paths['ndsm'], 'w', **_raster_profile(profile, 'float32', NODATA), predictor=3) as dst_ndsm, \
+            rasterio.open(paths['mask'], 'w', **_raster_profile(profile, 'uint8', MASK_NODATA)) as dst_mask, \
+            fiona.open(paths['polygons'], 'w', driver='GPKG', schema=schema, crs=CRS.from_wkt(crs.to_wkt())) as dst_poly:
+
+        def write(polys):
+            for poly in polys:
+                if poly.area >= min_area:
+                    dst_poly.write({'geometry': mapping(poly), 'properties': {'area': poly.area}})
+
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            work = partial(compute_block, str(mnt), str(mns), str(forest) if forest else None, threshold)
+            for window, (ndsm, mask, inner, seams) in bounded_map(pool, work, windows, 2 * max_workers):
+                dst_ndsm.write(ndsm, 1, window=window)
+                dst_mask.write(mask, 1, window=window)
+                write(inner)
+                all_seams += seams
+        if all_seams:
+            # Pieces of the same polygon share their edges along the seams
+            write(shapely.get_parts(shapely.union_all(all_seams)))
+    return paths
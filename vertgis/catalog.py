@@ -0,0 +1,240 @@
+"""Persistent local catalogue of STAC items.
+
+Items are stored per collection in a SQLite database with an R*Tree index on
+their WGS84 bbox, so repeated bbox queries are answered locally. Each listing
+is recorded as a covered area; the staleness policy in ``vertgis.config``
+decides when a covered area has to be revalidated against the API.
+"""
+import datetime
+import json
+import sqlite3
+import threading
+import time
+
+import requests
+
+from vertgis import config
+from vertgis.stac import collection_id, iter_items, search_updated_items, fetch_collection, list_items_many
+
+DB_NAME = 'stac_catalog.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    rowid INTEGER PRIMARY KEY,
+    collection TEXT NOT NULL,
+    id TEXT NOT NULL,
+    updated TEXT,
+    item TEXT NOT NULL,
+    UNIQUE (collection, id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS items_rtree USING rtree(rowid, xmin, xmax, ymin, ymax);
+CREATE TABLE IF NOT EXISTS assets (
+    href TEXT PRIMARY KEY,
+    item_rowid INTEGER NOT NULL,
+    asset TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS assets_item ON assets (item_rowid);
+CREATE TABLE IF NOT EXISTS coverage (
+    collection TEXT NOT NULL,
+    xmin REAL, ymin REAL, xmax REAL, ymax REAL,
+    synced_at REAL NOT NULL,
+    listed_at REAL NOT NULL,
+    collection_updated TEXT
+);
+CREATE INDEX IF NOT EXISTS coverage_collection ON coverage (collection);
+"""
+
+_write_lock = threading.Lock()
+
+
+def connect(path=None):
+    path = path or config.CACHE_DIR / DB_NAME
+    path.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(path, timeout=60)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.executescript(SCHEMA)
+    return con
+
+
+def item_bbox(item):
+    if item.get('bbox'):
+        xmin, ymin, *rest = item['bbox']
+        # 3D bboxes are (xmin, ymin, zmin, xmax, ymax, zmax)
+        xmax, ymax = rest[-3:-1] if len(rest) == 4 else rest
+        return xmin, ymin, xmax, ymax
+    coords = []
+
+    def walk(c):
+        if isinstance(c[0], (int, float)):
+            coords.append(c)
+        else:
+            for sub in c:
+                walk(sub)
+    walk(item['geometry']['coordinates'])
+    xs, ys = [c[0] for c in coords], [c[1] for c in coords]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _iso(ts):
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def upsert_items(con, collection, items):
+    # Only items whose ``updated`` timestamp changed are rewritten
+    seen = set()
+    for item in items:
+        seen.add(item['id'])
+        updated = item.get('properties', {}).get('updated')
+        row = con.execute('SELECT rowid, updated FROM items WHERE collection=? AND id=?', (collection, item['id'])).fetchone()
+        if row and row[1] == updated:
+            continue
+        if row:
+            rowid = row[0]
+            con.execute('UPDATE items SET updated=?, item=? WHERE rowid=?', (updated, json.dumps(item), rowid))
+            con.execute('DELETE FROM assets WHERE item_rowid=?', (rowid,))
+        else:
+            rowid = con.execute(
+                'INSERT INTO items (collection, id, updated, item) VALUES (?, ?, ?, ?)',
+                (collection, item['id'], updated, json.dumps(item)),
+            ).lastrowid
+        xmin, ymin, xmax, ymax = item_bbox(item)
+        con.execute('INSERT OR REPLACE INTO items_rtree VALUES (?, ?, ?, ?, ?)', (rowid, xmin, xmax, ymin, ymax))
+        con.executemany(
+            'INSERT OR REPLACE INTO assets VALUES (?, ?, ?)',
+            [(asset['href'], rowid, json.dumps(asset)) for asset in item.get('assets', {}).values() if 'href' in asset],
+        )
+    return seen
+
+
+def _rowids_in_bbox(con, collection, bbox):
+    xmin, ymin, xmax, ymax = bbox
+    return con.execute(
+        'SELECT i.rowid, i.id FROM items_rtree r JOIN items i ON i.rowid = r.rowid '
+        'WHERE i.collection=? AND r.xmax>=? AND r.xmin<=? AND r.ymax>=? AND r.ymin<=?',
+        (collection, xmin, xmax, ymin, ymax),
+    ).fetchall()
+
+
+def delete_missing(con, collection, bbox, seen):
+    # After a full listing of bbox, local items of the bbox not returned by the API are gone
+    for rowid, item_id in _rowids_in_bbox(con, collection, bbox):
+        if item_id not in seen:
+            con.execute('DELETE FROM items WHERE rowid=?', (rowid,))
+            con.execute('DELETE FROM items_rtree WHERE rowid=?', (rowid,))
+            con.execute('DELETE FROM assets WHERE item_rowid=?', (rowid,))
+
+
+def query(con, collection, bbox):
+    xmin, ymin, xmax, ymax = bbox
+    rows = con.execute(
+        'SELECT i.item FROM items_rtree r JOIN items i ON i.rowid = r.rowid '
+        'WHERE i.collection=? AND r.xmax>=? AND r.xmin<=? AND r.ymax>=? AND r.ymin<=? ORDER BY i.id',
+        (collection, xmin, xmax, ymin, ymax),
+    ).fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+
+def covering(con, collection, bbox):
+    # Most recent listing whose area contains bbox
+    xmin, ymin, xmax, ymax = bbox
+    return con.execute(
+        'SELECT synced_at, listed_at, collection_updated FROM coverage '
+        'WHERE collection=? AND xmin<=? AND ymin<=? AND xmax>=? AND ymax>=? ORDER BY synced_at DESC LIMIT 1',
+        (collection, xmin, ymin, xmax, ymax),
+    ).fetchone()
+
+
+def refresh(con, collection, bbox, cover=None, full_refresh_age=None):
+    full_refresh_age = config.STAC_FULL_REFRESH_AGE if full_refresh_age is None else full_refresh_age
+    now = time.time()
+    try:
+        collection_updated = fetch_collection(collection).get('updated')
+    except requests.RequestException:
+        collection_updated = None
+
+    if cover and now - cover[1] < full_refresh_age:
+        synced_at, listed_at, known_updated = cover
+        if collection_updated and known_updated and collection_updated <= known_updated:
+            # Nothing changed in the collection since the last sync
+            items = None
+        else:
+            try:
+                items = list(search_updated_items(collection, bbox, _iso(synced_at - 60)))
+            except requests.HTTPError:
+                items = False
+        if items is not False:
+            with _write_lock, con:
+                if items:
+                    upsert_items(con, collection, items)
+                con.execute('INSERT INTO coverage VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (collection, *bbox, now, listed_at, collection_updated))
+            return
+
+    items = list(iter_items(collection, bbox))
+    with _write_lock, con:
+        seen = upsert_items(con, collection, items)
+        delete_missing(con, collection, bbox, seen)
+        con.execute('INSERT INTO coverage VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (collection, *bbox, now, now, collection_updated))
+
+
+def get_items(collection, bbox, max_age=None, con=None):
+    """Items of ``collection`` intersecting ``bbox`` (WGS84), served locally.
+
+    The API is only queried when no listing younger than ``max_age`` seconds
+    covers the bbox (``config.STAC_MAX_AGE`` by default).
+    """
+    max_age = config.STAC_MAX_AGE if max_age is None else max_age
+    collection = collection_id(collection)
+    bbox = tuple(float(v) for v in bbox)
+    own = con is None
+    con = con or connect()
+    try:
+        cover = covering(con, collection, bbox)
+        if cover is None or time.time() - cover[0] >= max_age:
+            refresh(con, collection, bbox, cover)
+        return query(con, collection, bbox)
+    finally:
+        if own:
+            con.close()
+
+
+def get_items_many(collections, bbox, max_workers=None, max_age=None):
+    return list_items_many(collections, bbox, max_workers, lambda c, b: get_items(c, b, max_age))
+
+
+def asset_checksum(asset):
+    # STAC 0.9 uses checksum:multihash, the file extension file:checksum
+    return asset.get('checksum:multihash') or asset.get('file:checksum')
+
+
+def lookup_assets(hrefs, con=None):
+    """Asset dicts (checksum, size, ...) of already catalogued hrefs."""
+    own = con is None
+    con = con or connect()
+    try:
+        res = {}
+        for href in hrefs:
+            row = con.execute('SELECT asset FROM assets WHERE href=?', (href,)).fetchone()
+            if row:
+                res[href] = json.loads(row[0])
+        return res
+    finally:
+        if own:
+            con.close()
+
+
+def lookup_asset_items(hrefs, con=None):
+    """Items owning already catalogued hrefs, as {href: item}."""
+    own = con is None
+    con = con or connect()
+    try:
+        res = {}
+        for href in hrefs:
+            row = con.execute(
+                'SELECT i.item FROM assets a JOIN items i ON i.rowid = a.item_rowid WHERE a.href=?', (href,)
+            ).fetchone()
+            if row:
+                res[href] = json.loads(row[0])
+        return res
+    finally:
+        if own:
+            con.close()
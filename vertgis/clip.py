@@ -0,0 +1,81 @@
+"""Clip-on-read of Cloud-Optimized GeoTIFFs.
+
+swissALTI3D and swissSURFACE3D tiles are COGs: through ``/vsicurl/`` GDAL
+fetches only the internal blocks that intersect the requested window with
+HTTP range requests. The windows of all tiles are written into a single
+raster covering the bbox, instead of downloading every tile in full.
+"""
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import from_bounds
+
+GDAL_HTTP_ENV = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif',
+    'GDAL_HTTP_MULTIRANGE': 'YES',
+    'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+    'GDAL_HTTP_MAX_RETRY': '3',
+    'GDAL_HTTP_RETRY_DELAY': '1',
+    'VSI_CACHE': 'TRUE',
+}
+
+
+def vsicurl(url):
+    return url if url.startswith('/vsi') else '/vsicurl/' + url
+
+
+def snap_bbox(bbox, res):
+    xmin, ymin, xmax, ymax = bbox
+    return (
+        math.floor(xmin / res) * res,
+        math.floor(ymin / res) * res,
+        math.ceil(xmax / res) * res,
+        math.ceil(ymax / res) * res,
+    )
+
+
+def _read_window(url, bounds):
+    with rasterio.Env(**GDAL_HTTP_ENV), rasterio.open(vsicurl(url)) as src:
+        left, bottom, right, top = src.bounds
+        inter = (max(bounds[0], left), max(bounds[1], bottom), min(bounds[2], right), min(bounds[3], top))
+        if inter[0] >= inter[2] or inter[1] >= inter[3]:
+            return None, None
+        win = from_bounds(*inter, transform=src.transform).round_offsets().round_lengths()
+        return inter, src.read(window=win)
+
+
+def clip_cogs(urls, bbox_lv95, dst, max_workers=8, compress='deflate'):
+    """Write the part of the COG tiles ``urls`` inside ``bbox_lv95`` to ``dst``.
+
+    Tiles are written in the order of ``urls``, so where tiles overlap (two
+    acquisition years of the same sheet) the last one wins.
+    """
+    with rasterio.Env(**GDAL_HTTP_ENV), rasterio.open(vsicurl(urls[0])) as src:
+        profile = src.profile
+        res = src.res[0]
+    bounds = snap_bbox(bbox_lv95, res)
+    profile.update(
+        driver='GTiff',
+        width=round((bounds[2] - bounds[0]) / res),
+        height=round((bounds[3] - bounds[1]) / res),
+        transform=from_origin(bounds[0], bounds[3], res, res),
+        tiled=True,
+        blockxsize=512,
+        blockysize=512,
+        compress=compress,
+        predictor=3 if profile['dtype'].startswith('float') else 2,
+        BIGTIFF='IF_SAFER',
+    )
+    for key in ('interleave', 'photometric'):
+        profile.pop(key, None)
+    with rasterio.open(dst, 'w', **profile) as out:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for inter, data in pool.map(lambda url: _read_window(url, bounds), urls):
+                if data is None:
+                    continue
+                win = from_bounds(*inter, transform=out.transform).round_offsets().round_lengths()
+                out.write(data, window=win)
+    return dst
@@ -0,0 +1,111 @@
+"""Cloud-Optimized GeoTIFF writer.
+
+Rasters and tile mosaics are written with the GDAL COG driver: tiled,
+internal overviews placed before the image data, so clients can stream any
+window or zoom level with a few range requests. Compression and overview
+computation run on all cores. Imagery is compressed with ZSTD and a
+horizontal predictor, floating point data (DEMs) with LERC, lossless unless
+a maximum error is given. Clipping to an area of interest warps only the
+requested window, with the warper running on all cores.
+"""
+import uuid
+
+from osgeo import gdal
+
+gdal.UseExceptions()
+
+BLOCK_SIZE = 512
+ZSTD_LEVEL = 9
+FALLBACK_COMPRESS = 'DEFLATE'
+
+
+def _supported(compress):
+    # ZSTD and LERC are optional in GDAL builds
+    options = gdal.GetDriverByName('COG').GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''
+    return f'<Value>{compress}</Value>' in options
+
+
+def default_compress(data_type):
+    floating = data_type in (gdal.GDT_Float32, gdal.GDT_Float64)
+    compress = 'LERC_ZSTD' if floating else 'ZSTD'
+    return compress if _supported(compress) else FALLBACK_COMPRESS
+
+
+def cog_options(compress='ZSTD', resampling='AVERAGE', max_z_error=0, threads='ALL_CPUS', block_size=BLOCK_SIZE):
+    """Creation options of the COG driver."""
+    options = [
+        f'COMPRESS={compress}',
+        f'NUM_THREADS={threads}',
+        f'BLOCKSIZE={block_size}',
+        'OVERVIEWS=IGNORE_EXISTING',
+        f'RESAMPLING={resampling}',
+        'BIGTIFF=IF_SAFER',
+    ]
+    if compress.startswith('LERC'):
+        options.append(f'MAX_Z_ERROR={max_z_error}')
+    else:
+        options.append('PREDICTOR=YES')
+    if compress in ('ZSTD', 'LERC_ZSTD'):
+        options.append(f'LEVEL={ZSTD_LEVEL}')
+    return options
+
+
+def write_cog(src, output_file, compress=None, resampling='AVERAGE', max_z_error=0, threads='ALL_CPUS'):
+    """Write ``src`` (a path or an open dataset, e.g. a VRT) as a COG."""
+    ds = gdal.Open(src) if isinstance(src, str) else src
+    compress = compress or default_compress(ds.GetRasterBand(1).DataType)
+    gdal.SetConfigOption('GDAL_NUM_THREADS', str(threads))
+    gdal.Translate(
+        str(output_file), ds, format='COG',
+        creationOptions=cog_options(compress, resampling, max_z_error, threads),
+    )
+    return output_file
+
+
+def clip_vrt(input_files, vrt_path, bounds=None, bounds_srs='EPSG:4326', cutline=None, res=None,
+             dst_srs='EPSG:2056', threads='ALL_CPUS'):
+    """Warped VRT of ``input_files`` cut to an area of interest, written to ``vrt_path``.
+
+    The output covers ``bounds`` (in ``bounds_srs``), or the extent of the
+    ``cutline`` vector file, pixels outside its geometries being transparent.
+    ``res`` is the pixel size in ``dst_srs`` units, the native one by default.
+    Nothing is computed until the VRT is read, and then only its window.
+    """
+    src = gdal.BuildVRT(vrt_path + '.src.vrt', [str(f) for f in input_files])
+    # The tiles are expected in dst_srs already (LV95), so this is their native pixel size
+    native = abs(src.GetGeoTransform()[1])
+    res = res or native
+    options = dict(
+        format='VRT',
+        dstSRS=dst_srs,
+        xRes=res,
+        yRes=res,
+        targetAlignedPixels=True,
+        resampleAlg='average' if res > native else 'cubic',
+        # Transparency outside the area for imagery, not for elevation data
+        dstAlpha=src.GetRasterBand(1).DataType == gdal.GDT_Byte,
+        multithread=True,
+        warpOptions=[f'NUM_THREADS={threads}'],
+    )
+    if cutline:
+        options.update(cutlineDSName=str(cutline), cropToCutline=True)
+    else:
+        options.update(outputBounds=list(bounds), outputBoundsSRS=bounds_srs)
+    return gdal.Warp(vrt_path, src, options=gdal.WarpOptions(**options))
+
+
+def unlink_vrt(vrt_path):
+    gdal.Unlink(vrt_path)
+    gdal.Unlink(vrt_path + '.src.vrt')
+
+
+def clip_to_cog(input_files, output_file, bounds=None, bounds_srs='EPSG:4326', cutline=None, res=None,
+                dst_srs='EPSG:2056', compress=None, max_z_error=0, threads='ALL_CPUS'):
+    """Warp ``input_files`` to an area of interest in one pass and write a COG (see clip_vrt)."""
+    vrt_path = f'/vsimem/{uuid.uuid4().hex}.vrt'
+    warped = clip_vrt(input_files, vrt_path, bounds, bounds_srs, cutline, res, dst_srs, threads)
+    try:
+        return write_cog(warped, output_file, compress, 'AVERAGE', max_z_error, threads)
+    finally:
+        warped = None
+        unlink_vrt(vrt_path)
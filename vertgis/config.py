@@ -0,0 +1,21 @@
+"""Runtime settings, overridable through environment variables."""
+import os
+from pathlib import Path
+
+CACHE_DIR = Path(os.environ.get('VERTGIS_CACHE_DIR', Path.home() / '.cache' / 'vertgis'))
+
+# STAC catalogue staleness policy (seconds): answers younger than
+# STAC_MAX_AGE are served locally without any request, older ones are
+# revalidated incrementally, and areas are listed again in full after
+# STAC_FULL_REFRESH_AGE to catch deleted items.
+STAC_MAX_AGE = float(os.environ.get('VERTGIS_STAC_MAX_AGE', 24 * 3600))
+STAC_FULL_REFRESH_AGE = float(os.environ.get('VERTGIS_STAC_FULL_REFRESH_AGE', 30 * 24 * 3600))
+
+# Shared content-addressed tile store, evicted least-recently-used first
+STORE_DIR = Path(os.environ.get('VERTGIS_STORE_DIR', CACHE_DIR / 'store'))
+STORE_MAX_BYTES = int(float(os.environ.get('VERTGIS_STORE_MAX_GB', 50)) * 1024 ** 3)
+
+# Preflight budget of one extraction job (bytes to download), and what to do
+# with jobs above it: 'refuse' them or 'split' them into batches
+JOB_MAX_BYTES = int(float(os.environ.get('VERTGIS_JOB_MAX_GB', 20)) * 1024 ** 3)
+JOB_OVER_BUDGET = os.environ.get('VERTGIS_JOB_OVER_BUDGET', 'split')
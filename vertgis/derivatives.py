@@ -0,0 +1,140 @@
+"""Terrain derivatives (hillshade, slope, aspect, roughness) of a DEM.
+
+The DEM is processed in blocks read with a one-pixel halo, so 3x3 kernels
+are exact across block edges. Blocks are computed with vectorized NumPy
+kernels in a process pool while the parent process writes tiled,
+compressed outputs; only a bounded number of blocks is in memory at once.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import rasterio
+
+from vertgis.windows import BLOCK_SIZE, open_cached, iter_windows, read_with_halo, bounded_map
+
+PRODUCTS = ('hillshade', 'slope', 'aspect', 'roughness')
+NODATA = -9999.0
+
+
+def _neighbours(z):
+    # The 3x3 neighbourhood of every inner pixel of z, as shifted views
+    #   a b c
+    #   d e f
+    #   g h i
+    return (z[:-2, :-2], z[:-2, 1:-1], z[:-2, 2:],
+            z[1:-1, :-2], z[1:-1, 1:-1], z[1:-1, 2:],
+            z[2:, :-2], z[2:, 1:-1], z[2:, 2:])
+
+
+def gradients(z, res_x, res_y):
+    # Horn's method; y points north, rows go south
+    a, b, c, d, e, f, g, h, i = _neighbours(z)
+    dzdx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8 * res_x)
+    dzdy = ((a + 2 * b + c) - (g + 2 * h + i)) / (8 * res_y)
+    return dzdx, dzdy
+
+
+def slope(dzdx, dzdy):
+    return np.degrees(np.arctan(np.hypot(dzdx, dzdy)))
+
+
+def aspect(dzdx, dzdy):
+    # Compass direction of the downslope, clockwise from north; -1 on flats
+    res = np.degrees(np.arctan2(-dzdx, -dzdy)) % 360
+    return np.where((dzdx == 0) & (dzdy == 0), -1.0, res)
+
+
+def hillshade(dzdx, dzdy, azimuth=315.0, altitude=45.0):
+    zenith = np.radians(90 - altitude)
+    slope_rad = np.arctan(np.hypot(dzdx, dzdy))
+    aspect_rad = np.arctan2(-dzdx, -dzdy)
+    shade = np.cos(zenith) * np.cos(slope_rad) + np.sin(zenith) * np.sin(slope_rad) * np.cos(np.radians(azimuth) - aspect_rad)
+    return np.clip(shade * 255, 0, 255)
+
+
+def roughness(z):
+    # Largest elevation difference within the 3x3 window
+    stack = np.stack(_neighbours(z))
+    return stack.max(axis=0) - stack.min(axis=0)
+
+
+def compute_block(path, products, window):
+    """{product: array} of ``window``, plus 'valid' (uint8 mask, 255 = data)."""
+    src = open_cached(path)
+    z = read_with_halo(src, window, halo=1)
+    res_x, res_y = src.res
+    dzdx, dzdy = gradients(z, res_x, res_y)
+    # Any NaN of the 3x3 window: dzdx and dzdy cover the ring, not the centre
+    nodata = np.isnan(dzdx) | np.isnan(dzdy) | np.isnan(z[1:-1, 1:-1])
+    res = {'valid': np.where(nodata, 0, 255).astype('uint8')}
+    for product in products:
+        if product == 'hillshade':
+            # Every uint8 value is a valid shade: nodata goes to the mask band
+            res[product] = np.where(nodata, 0, hillshade(dzdx, dzdy)).astype('uint8')
+            continue
+        if product == 'slope':
+            data = slope(dzdx, dzdy)
+        elif product == 'aspect':
+            data = aspect(dzdx, dzdy)
+        else:
+            data = roughness(z)
+            data_nodata = np.isnan(np.stack(_neighbours(z))).any(axis=0)
+            res[product] = np.where(data_nodata, NODATA, data).astype('float32')
+            continue
+        res[product] = np.where(nodata, NODATA, data).astype('float32')
+    return res
+
+
+def output_profile(src_profile, product):
+    profile = {
+        'driver': 'GTiff',
+        'width': src_profile['width'],
+        'height': src_profile['height'],
+        'count': 1,
+        'crs': src_profile['crs'],
+        'transform': src_profile['transform'],
+        'tiled': True,
+        'blockxsize': 512,
+        'blockysize': 512,
+        'compress': 'deflate',
+        'BIGTIFF': 'IF_SAFER',
+        'NUM_THREADS': 'ALL_CPUS',
+    }
+    if product == 'hillshade':
+        # nodata is carried by an internal mask band (see compute_derivatives)
+        profile.update(dtype='uint8')
+    else:
+        profile.update(dtype='float32', nodata=NODATA, predictor=3)
+    return profile
+
+
+def compute_derivatives(dem, out_dir, products=PRODUCTS, block=BLOCK_SIZE, max_workers=None):
+    """Write one GeoTIFF per product of ``products`` computed from ``dem``.
+
+    Returns {product: path}.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    max_workers = max_workers or os.cpu_count() or 1
+    with rasterio.open(dem) as src:
+        profile = src.profile
+        windows = list(iter_windows(src.width, src.height, block))
+    paths = {p: out_dir / f'{Path(dem).stem}_{p}.tif' for p in products}
+    with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True):
+        outputs = {p: rasterio.open(paths[p], 'w', **output_profile(profile, p)) for p in products}
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                work = partial(compute_block, str(dem), tuple(products))
+                for window, res in bounded_map(pool, work, windows, 2 * max_workers):
+                    valid = res.pop('valid')
+                    for product, data in res.items():
+                        outputs[product].write(data, 1, window=window)
+                    if 'hillshade' in outputs:
+                        outputs['hillshade'].write_mask(valid, window=window)
+        finally:
+            for dst in outputs.values():
+                dst.close()
+    return paths
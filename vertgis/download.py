@@ -0,0 +1,288 @@
+"""Concurrent download engine for STAC assets.
+
+Files are fetched by a bounded pool of worker threads sharing one pooled HTTP
+session and streamed to disk in chunks. An interrupted file keeps its
+``.part`` and is resumed with an HTTP Range request, guarded by If-Range so
+that a file changed on the server is fetched again from the start. When the
+STAC checksum of a file is known, its hash is computed on the chunks as they
+arrive, so a corrupt file is re-fetched without reading it back from disk.
+Progress is reported from the calling thread, so the callback can safely
+update Streamlit widgets.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+from vertgis.net import make_session, TIMEOUT
+
+MAX_WORKERS = 8
+CHUNK_SIZE = 1 << 20
+MAX_ATTEMPTS = 3
+
+# Multihash function codes (https://multiformats.io/multihash/)
+MULTIHASH_CODES = {0x11: 'sha1', 0x12: 'sha256', 0x13: 'sha512', 0xd5: 'md5'}
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def _varint(data, i):
+    value = shift = 0
+    while True:
+        byte = data[i]
+        value |= (byte & 0x7f) << shift
+        i += 1
+        if not byte & 0x80:
+            return value, i
+        shift += 7
+
+
+def parse_multihash(multihash):
+    """(hashlib name, hex digest) of a hex encoded multihash such as ``1220<sha256>``."""
+    data = bytes.fromhex(multihash)
+    code, i = _varint(data, 0)
+    length, i = _varint(data, i)
+    if code not in MULTIHASH_CODES or len(data) - i != length:
+        raise ValueError(f'Unsupported multihash: {multihash[:8]}...')
+    return MULTIHASH_CODES[code], data[i:].hex()
+
+
+def new_hash(checksum):
+    """(hash object, expected hex digest) for ``checksum``, or None if it cannot be verified."""
+    if not checksum:
+        return None
+    try:
+        name, digest = parse_multihash(checksum)
+    except ValueError:
+        return None
+    return hashlib.new(name), digest
+
+
+class DownloadProgress:
+    def __init__(self, total_files):
+        self.total_files = total_files
+        self.done_files = 0
+        self.failed_files = 0
+        self.bytes_done = 0
+        self.files = {}
+        self.started = time.monotonic()
+        self.finished = None
+        self._samples = deque([(self.started, 0)], maxlen=20)
+        self._lock = threading.Lock()
+
+    def start_file(self, url, size, offset=0):
+        # ``offset`` bytes were already on disk from an interrupted attempt
+        with self._lock:
+            self.files[url] = [offset, size]
+
+    def add(self, url, n):
+        with self._lock:
+            self.bytes_done += n
+            self.files[url][0] += n
+
+    def end_file(self, url, ok):
+        with self._lock:
+            if ok:
+                self.done_files += 1
+            else:
+                self.failed_files += 1
+            if self.done_files + self.failed_files == self.total_files:
+                # Frozen here, so that work done after the downloads is not timed
+                self.finished = time.monotonic()
+
+    def snapshot(self):
+        """[(url, [done, size])] of the files started so far, safe to iterate."""
+        with self._lock:
+            return [(url, list(state)) for url, state in self.files.items()]
+
+    def sample(self):
+        self._samples.append((time.monotonic(), self.bytes_done))
+
+    def _bytes_total(self):
+        # Only known once every file has answered with a Content-Length
+        sizes = [size for _, size in self.files.values()]
+        if len(sizes) < self.total_files or None in sizes:
+            return None
+        return sum(sizes)
+
+    @property
+    def rate(self):
+        # Throughput over the last samples (bytes/s)
+        (t0, b0), (t1, b1) = self._samples[0], self._samples[-1]
+        return (b1 - b0) / (t1 - t0) if t1 > t0 else 0.0
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def fraction(self):
+        with self._lock:
+            total = self._bytes_total()
+            if total:
+                return min(sum(done for done, _ in self.files.values()) / total, 1.0)
+            if self.total_files:
+                return (self.done_files + self.failed_files) / self.total_files
+            return 1.0
+
+
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n) < 1024:
+            return f'{n:.1f} {unit}'
+        n /= 1024
+    return f'{n:.1f} TB'
+
+
+def _validator(r):
+    # If-Range needs a strong ETag, or else the Last-Modified date
+    etag = r.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return r.headers.get('Last-Modified')
+
+
+def _resume_offset(tmp, meta):
+    if not tmp.exists() or not meta.exists():
+        return 0, None
+    try:
+        validator = json.loads(meta.read_text())['validator']
+    except (OSError, ValueError, KeyError):
+        return 0, None
+    return (tmp.stat().st_size, validator) if validator else (0, None)
+
+
+def _hash_file(h, path, chunk_size=CHUNK_SIZE):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+
+def verify_file(path, checksum):
+    """True or False if ``path`` matches ``checksum``, None if it cannot be verified."""
+    verify = new_hash(checksum)
+    if not verify:
+        return None
+    _hash_file(verify[0], path)
+    return verify[0].hexdigest() == verify[1]
+
+
+def fetch(session, url, dest, progress=None, chunk_size=CHUNK_SIZE, checksum=None):
+    """Stream ``url`` to ``dest``, resuming a previous ``.part`` if possible.
+
+    Raises ChecksumError if the file does not match ``checksum``.
+    """
+    dest = Path(dest)
+    tmp = dest.with_name(dest.name + '.part')
+    meta = dest.with_name(dest.name + '.part.json')
+    offset, validator = _resume_offset(tmp, meta)
+    headers = {'Range': f'bytes={offset}-', 'If-Range': validator} if offset else {}
+    with session.get(url, stream=True, timeout=TIMEOUT, headers=headers) as r:
+        if r.status_code == 416 and offset:
+            # The part does not fit the current file any more: start over
+            tmp.unlink(missing_ok=True)
+            meta.unlink(missing_ok=True)
+            return fetch(session, url, dest, progress, chunk_size, checksum)
+        r.raise_for_status()
+        if r.status_code != 206 or not r.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+            offset = 0
+            meta.write_text(json.dumps({'url': url, 'validator': _validator(r)}))
+        length = int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+        size = offset + length if length is not None else None
+        verify = new_hash(checksum)
+        if verify and offset:
+            # Only the resumed prefix is read back
+            _hash_file(verify[0], tmp, chunk_size)
+        if progress:
+            progress.start_file(url, size, offset)
+        with open(tmp, 'ab' if offset else 'wb') as f:
+            for chunk in r.iter_content(chunk_size):
+                f.write(chunk)
+                if verify:
+                    verify[0].update(chunk)
+                if progress:
+                    progress.add(url, len(chunk))
+    if verify and verify[0].hexdigest() != verify[1]:
+        os.remove(tmp)
+        meta.unlink(missing_ok=True)
+        raise ChecksumError(f'Checksum mismatch for {url}')
+    os.replace(tmp, dest)
+    meta.unlink(missing_ok=True)
+    return dest.stat().st_size
+
+
+def _is_client_error(e):
+    response = getattr(e, 'response', None)
+    return response is not None and 400 <= response.status_code < 500 and response.status_code not in (408, 429)
+
+
+def _fetch_with_retries(session, url, dest, progress, chunk_size, checksum=None):
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            size = fetch(session, url, dest, progress, chunk_size, checksum)
+            progress.end_file(url, True)
+            verified = True if new_hash(checksum) else None
+            return {'url': url, 'path': Path(dest), 'ok': True, 'size': size, 'error': None, 'verified': verified}
+        except Exception as e:
+            # The .part is kept: the next attempt resumes it
+            error = e
+            if _is_client_error(e):
+                break
+            if attempt < MAX_ATTEMPTS - 1:
+                time.sleep(2 ** attempt)
+    progress.end_file(url, False)
+    verified = False if isinstance(error, ChecksumError) else None
+    return {'url': url, 'path': Path(dest), 'ok': False, 'size': 0, 'error': str(error), 'verified': verified}
+
+
+def download_many(jobs, max_workers=MAX_WORKERS, chunk_size=CHUNK_SIZE, on_progress=None, interval=0.5,
+                  checksums=None, on_result=None):
+    """Download ``jobs`` (an iterable of ``(url, dest)``) concurrently.
+
+    Files with a checksum in ``checksums`` ({url: multihash}) are verified
+    while streaming and re-fetched on mismatch. ``on_result`` is called
+    from the calling thread with each result as soon as its file is done.
+    Returns one result dict per job, in the order of ``jobs``, with
+    ``verified`` True, False or None (nothing to verify against).
+    """
+    jobs = list(jobs)
+    checksums = checksums or {}
+    progress = DownloadProgress(len(jobs))
+    session = make_session(pool_size=max_workers)
+    results = [None] * len(jobs)
+    # The pool is shut down by hand: if a callback raises (a Streamlit rerun or
+    # stop), queued downloads are cancelled instead of being waited for
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {
+            pool.submit(_fetch_with_retries, session, url, dest, progress, chunk_size, checksums.get(url)): i
+            for i, (url, dest) in enumerate(jobs)
+        }
+        pending = set(futures)
+        last_report = 0.0
+        while pending:
+            done, pending = wait(pending, timeout=interval, return_when=FIRST_COMPLETED)
+            for fut in done:
+                results[futures[fut]] = fut.result()
+                if on_result:
+                    on_result(results[futures[fut]])
+            now = time.monotonic()
+            if now - last_report >= interval or not pending:
+                last_report = now
+                progress.sample()
+                if on_progress:
+                    on_progress(progress)
+    except BaseException:
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    else:
+        pool.shutdown()
+    finally:
+        session.close()
+    return results
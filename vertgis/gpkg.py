@@ -0,0 +1,64 @@
+"""Raster GeoPackage export.
+
+Each layer becomes its own tile matrix set table in a single GeoPackage,
+written by the GDAL GPKG driver from a warped VRT of the layer's tiles, so
+the imagery is streamed block by block and never held in memory. Every
+table gets its overview levels, so QGIS opens and pans it at any scale.
+"""
+import re
+import unicodedata
+import uuid
+
+from osgeo import gdal
+
+from vertgis.cog import clip_vrt, unlink_vrt
+from vertgis.mosaic import overview_levels
+
+gdal.UseExceptions()
+
+
+def table_name(name):
+    # GeoPackage table names: ASCII letters, digits and underscores
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode()
+    name = re.sub(r'\W+', '_', name).strip('_').lower()
+    return name if name[:1].isalpha() else f't_{name}'
+
+
+def write_layer(vrt, output_file, table, identifier=None, resampling='AVERAGE'):
+    options = [f'RASTER_TABLE={table}', 'APPEND_SUBDATASET=YES']
+    if identifier:
+        options.append(f'RASTER_IDENTIFIER={identifier}')
+    gdal.Translate(str(output_file), vrt, format='GPKG', creationOptions=options)
+    ds = gdal.OpenEx(str(output_file), gdal.OF_RASTER | gdal.OF_UPDATE, open_options=[f'TABLE={table}'])
+    levels = overview_levels(ds.RasterXSize, ds.RasterYSize)
+    if levels:
+        ds.BuildOverviews(resampling, levels)
+    ds = None
+
+
+def export_gpkg(layers, output_file, bounds=None, bounds_srs='EPSG:4326', cutline=None, res=None,
+                threads='ALL_CPUS'):
+    """Write ``layers`` ({name: [raster files]}) as raster tables of ``output_file``.
+
+    The tiles of each layer are cut to the area of interest as in
+    vertgis.cog.clip_vrt. Returns {name: table}.
+    """
+    tables = {}
+    for name, files in layers.items():
+        if not files:
+            continue
+        table = base = table_name(name)
+        n = 1
+        while table in tables.values():
+            # Another layer name normalized to the same table
+            n += 1
+            table = f'{base}_{n}'
+        vrt_path = f'/vsimem/{uuid.uuid4().hex}.vrt'
+        vrt = clip_vrt(files, vrt_path, bounds, bounds_srs, cutline, res, threads=threads)
+        try:
+            write_layer(vrt, output_file, table, name)
+        finally:
+            vrt = None
+            unlink_vrt(vrt_path)
+        tables[name] = table
+    return tables
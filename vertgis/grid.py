@@ -0,0 +1,166 @@
+"""swisstopo 1 km LV95 tile grid.
+
+swissALTI3D, swissSURFACE3D raster and SWISSIMAGE are cut in 1 km tiles named
+after the kilometre coordinates of their lower-left corner (``2600-1199``).
+The tiles of an area and their asset URLs can therefore be computed locally;
+only the acquisition year is unknown and is resolved with HEAD requests.
+"""
+import datetime
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+from vertgis.catalog import lookup_asset_items
+from vertgis.net import make_session, TIMEOUT
+from vertgis.reframe import transform_points, WGS84, LV95
+
+TILE_SIZE = 1000
+URL_DATA_BASE = 'https://data.geo.admin.ch/'
+FIRST_YEAR = 2017
+
+PRODUCTS = {
+    'mnt': {
+        'collection': 'ch.swisstopo.swissalti3d',
+        'name': 'swissalti3d',
+        'suffix': '_2056_5728.tif',
+        'resolutions': (0.5, 2),
+    },
+    'mns': {
+        'collection': 'ch.swisstopo.swisssurface3d-raster',
+        'name': 'swisssurface3d-raster',
+        'suffix': '_2056_5728.tif',
+        'resolutions': (0.5,),
+    },
+    'ortho': {
+        'collection': 'ch.swisstopo.swissimage-dop10',
+        'name': 'swissimage-dop10',
+        # Same format as the STAC listing selects, so both modes fill the same folders
+        'suffix': '_2056.png',
+        'resolutions': (0.1, 2),
+    },
+}
+
+TILE_ID_RE = re.compile(r'_(\d{4})-(\d{4})(?=[_.])')
+
+
+def tile_id(e_km, n_km):
+    return f'{e_km}-{n_km}'
+
+
+def parse_tile_id(href):
+    m = TILE_ID_RE.search(href.split('/')[-1])
+    return tile_id(*m.groups()) if m else None
+
+
+def tile_bounds(tile):
+    e_km, n_km = (int(v) for v in tile.split('-'))
+    return (e_km * TILE_SIZE, n_km * TILE_SIZE, (e_km + 1) * TILE_SIZE, (n_km + 1) * TILE_SIZE)
+
+
+def tiles_for_bbox(bbox_lv95):
+    xmin, ymin, xmax, ymax = bbox_lv95
+    e0, n0 = math.floor(xmin / TILE_SIZE), math.floor(ymin / TILE_SIZE)
+    # A bbox ending exactly on a kilometre line does not touch the next tile
+    e1 = max(e0, math.ceil(xmax / TILE_SIZE) - 1)
+    n1 = max(n0, math.ceil(ymax / TILE_SIZE) - 1)
+    return [tile_id(e, n) for e in range(e0, e1 + 1) for n in range(n0, n1 + 1)]
+
+
+def tile_footprints(tiles):
+    return shapely.box(*np.array([tile_bounds(t) for t in tiles], dtype='float64').reshape(-1, 4).T)
+
+
+def tiles_for_geometry(geometry):
+    # Tiles whose footprint intersects the (LV95) geometry, not only its bbox
+    tiles = tiles_for_bbox(geometry.bounds)
+    hits = shapely.intersects(tile_footprints(tiles), geometry)
+    return [t for t, hit in zip(tiles, hits) if hit]
+
+
+def _to_lv95(geometry):
+    return shapely.transform(geometry, lambda xy: np.column_stack(transform_points(xy[:, 0], xy[:, 1], WGS84, LV95)))
+
+
+def footprints(hrefs):
+    # LV95 footprint of each asset: from its tile ID on the 1 km grid, else
+    # from the geometry of its catalogued STAC item
+    res = {}
+    others = []
+    for href in hrefs:
+        tile = parse_tile_id(href)
+        if tile:
+            res[href] = shapely.box(*tile_bounds(tile))
+        else:
+            others.append(href)
+    for href, item in lookup_asset_items(others).items():
+        if item.get('geometry'):
+            res[href] = _to_lv95(shape(item['geometry']))
+    return res
+
+
+def select_intersecting(hrefs, aoi):
+    """Keep the assets whose footprint intersects the LV95 geometry ``aoi``.
+
+    Footprints go into an STRtree queried with the parts of the AOI, so a long
+    corridor only keeps the tiles it actually crosses. Assets without a known
+    footprint are kept.
+    """
+    hrefs = list(hrefs)
+    known = footprints(hrefs)
+    keys = list(known)
+    if not keys:
+        return hrefs
+    tree = shapely.STRtree([known[k] for k in keys])
+    hits = tree.query(shapely.get_parts(aoi), predicate='intersects')[1]
+    touching = {keys[i] for i in hits}
+    return [h for h in hrefs if h in touching or h not in known]
+
+
+def candidate_url(product, year, tile, resol):
+    spec = PRODUCTS[product]
+    stem = f"{spec['name']}_{year}_{tile}"
+    return f"{URL_DATA_BASE}{spec['collection']}/{stem}/{stem}_{resol:g}{spec['suffix']}"
+
+
+def _exists(session, url):
+    try:
+        r = session.head(url, timeout=TIMEOUT, allow_redirects=True)
+        return r.status_code == 200
+    except Exception:
+        return False
+
+
+def probe(urls, max_workers=32, session=None):
+    """HEAD ``urls`` concurrently; returns {url: exists}."""
+    urls = list(urls)
+    session = session or make_session(pool_size=max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return dict(zip(urls, pool.map(lambda u: _exists(session, u), urls)))
+
+
+def resolve_tiles(product, tiles, resol, years=None, max_workers=32):
+    """Asset URL of the most recent existing year of each tile.
+
+    Years are probed from the newest down, one wave of concurrent HEAD
+    requests per year for the tiles still unresolved.
+    """
+    if years is None:
+        years = range(datetime.date.today().year, FIRST_YEAR - 1, -1)
+    session = make_session(pool_size=max_workers)
+    res = {}
+    remaining = list(tiles)
+    for year in years:
+        if not remaining:
+            break
+        urls = {tile: candidate_url(product, year, tile, resol) for tile in remaining}
+        exists = probe(urls.values(), max_workers, session)
+        for tile, url in urls.items():
+            if exists[url]:
+                res[tile] = url
+        remaining = [t for t in remaining if t not in res]
+    session.close()
+    return [res[t] for t in tiles if t in res]
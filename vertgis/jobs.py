@@ -0,0 +1,140 @@
+"""Crash-safe extraction jobs.
+
+A job is journaled in ``journal.jsonl`` inside its extraction folder: the
+query and the asset list first, then one line per asset as soon as it is in
+place, each line flushed and fsynced. After a crash, a container restart or
+a Streamlit rerun, the journal tells which assets are done; only the others
+are fetched again, their ``.part`` files resumed with HTTP Range requests.
+"""
+import datetime
+import json
+import os
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+JOURNAL_NAME = 'journal.jsonl'
+LOCK_NAME = 'journal.lock'
+# A journal written to more recently than this is taken as running
+ACTIVE_AGE = 120
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+def _append(path, event):
+    with open(Path(path) / JOURNAL_NAME, 'ab+') as f:
+        # Never glue an event to a line torn by a crash
+        line = json.dumps(event).encode() + b'\n'
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                line = b'\n' + line
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def create(path, query, urls):
+    _append(path, {'event': 'job', 'query': query or {}, 'urls': list(urls), 'created': _now()})
+
+
+def log_result(path, result, checksum=None):
+    """Journal the outcome of one asset."""
+    event = {
+        'event': 'asset',
+        'url': result['url'],
+        'ok': result['ok'],
+        'size': result['size'],
+        'verified': result.get('verified'),
+        'checksum': checksum,
+        'error': result['error'],
+    }
+    if result['ok']:
+        event['path'] = Path(result['path']).relative_to(path).as_posix()
+    _append(path, event)
+
+
+def finish(path):
+    _append(path, {'event': 'finished', 'at': _now()})
+
+
+def load(path):
+    """Replay the journal of ``path``.
+
+    Returns {'query', 'urls', 'done': {url: result}, 'failed': {url: error},
+    'finished'}. A line torn by a crash is ignored.
+    """
+    path = Path(path)
+    job = {'query': {}, 'urls': [], 'done': {}, 'failed': {}, 'finished': False}
+    with open(path / JOURNAL_NAME) as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event['event'] == 'job':
+                job.update(query=event['query'], urls=event['urls'], finished=False)
+            elif event['event'] == 'asset':
+                if event['ok'] and (path / event['path']).exists():
+                    job['done'][event['url']] = {
+                        'url': event['url'],
+                        'path': path / event['path'],
+                        'ok': True,
+                        'size': event['size'],
+                        'error': None,
+                        'verified': event.get('verified'),
+                        'checksum': event.get('checksum'),
+                    }
+                    job['failed'].pop(event['url'], None)
+                elif not event['ok']:
+                    job['failed'][event['url']] = event['error']
+            elif event['event'] == 'finished':
+                job['finished'] = True
+    return job
+
+
+def pending(job):
+    return [url for url in job['urls'] if url not in job['done']]
+
+
+def lock(path):
+    """Hold the job of ``path`` for this session, or None if another session runs it.
+
+    The lock is released when the returned file is closed.
+    """
+    f = open(Path(path) / LOCK_NAME, 'a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+    return f
+
+
+def running(path):
+    journal = Path(path) / JOURNAL_NAME
+    if time.time() - journal.stat().st_mtime < ACTIVE_AGE:
+        return True
+    held = lock(path)
+    if held is None:
+        return True
+    held.close()
+    return False
+
+
+def unfinished(root):
+    """Extraction folders of ``root`` whose job was interrupted, not those still running."""
+    root = Path(root)
+    if not root.exists():
+        return []
+    return sorted(
+        (p for p in root.iterdir() if (p / JOURNAL_NAME).exists() and not load(p)['finished'] and not running(p)),
+        reverse=True,
+    )
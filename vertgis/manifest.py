@@ -0,0 +1,79 @@
+"""Extraction manifests.
+
+Every extraction folder holds a ``manifest.json`` listing the assets it
+contains (relative path, checksum, size, whether the checksum was verified
+while downloading) and the query that produced them, so a later run can
+fetch only what changed since.
+"""
+import datetime
+import json
+import os
+from pathlib import Path
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+def new_manifest(query=None):
+    return {'created': _now(), 'updated': _now(), 'query': query or {}, 'assets': {}}
+
+
+def load(path):
+    fn = Path(path) / MANIFEST_NAME
+    if not fn.exists():
+        return new_manifest()
+    with open(fn) as f:
+        return json.load(f)
+
+
+def save(path, manifest):
+    # Written next to the target and renamed, so a crash never leaves half a manifest
+    fn = Path(path) / MANIFEST_NAME
+    tmp = fn.with_name(fn.name + '.tmp')
+    manifest['updated'] = _now()
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, fn)
+
+
+def record(manifest, path, results, checksums=None):
+    checksums = checksums or {}
+    for r in results:
+        if r['ok']:
+            manifest['assets'][r['url']] = {
+                'path': Path(r['path']).relative_to(path).as_posix(),
+                'checksum': checksums.get(r['url']),
+                'size': r['size'],
+                'verified': r.get('verified'),
+                'fetched': _now(),
+            }
+    return manifest
+
+
+def diff(manifest, urls, checksums=None):
+    """Split the current listing against a manifest.
+
+    Returns ``(new, changed, removed)``: URLs not in the manifest, URLs whose
+    checksum moved, and manifest URLs no longer listed (e.g. a swissimage tile
+    superseded by a newer year).
+    """
+    checksums = checksums or {}
+    assets = manifest['assets']
+    new = [u for u in urls if u not in assets]
+    changed = [
+        u for u in urls
+        if u in assets and checksums.get(u) and assets[u].get('checksum') != checksums[u]
+    ]
+    listed = set(urls)
+    removed = [u for u in assets if u not in listed]
+    return new, changed, removed
+
+
+def find_extractions(root):
+    root = Path(root)
+    if not root.exists():
+        return []
+    return sorted((p for p in root.iterdir() if (p / MANIFEST_NAME).exists()), reverse=True)
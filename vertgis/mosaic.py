@@ -0,0 +1,71 @@
+"""VRT mosaics with shared overviews for extracted products.
+
+Each product directory of an extraction gets a ``<directory>.vrt`` next to
+it, referencing the tiles in place (nothing is copied), plus an external
+``.vrt.ovr`` overview pyramid. Products are processed by a process pool and
+GDAL splits the overview computation of each product across threads.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from osgeo import gdal
+
+gdal.UseExceptions()
+
+RASTER_EXTENSIONS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg')
+MIN_OVERVIEW_SIZE = 256
+
+
+def product_dirs(path, products=None):
+    # Only the named product directories: derived outputs (derivatives/,
+    # canopy/) also hold rasters but are not mosaicked
+    return sorted(
+        p for p in Path(path).iterdir()
+        if p.is_dir() and (products is None or p.name in products)
+        and any(f.suffix.lower() in RASTER_EXTENSIONS for f in p.iterdir())
+    )
+
+
+def overview_levels(width, height, min_size=MIN_OVERVIEW_SIZE):
+    levels = []
+    factor = 2
+    while max(width, height) / factor >= min_size:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def build_product(directory, resampling='AVERAGE', threads=1):
+    directory = Path(directory)
+    tiles = sorted(str(f) for f in directory.iterdir() if f.suffix.lower() in RASTER_EXTENSIONS)
+    vrt_path = directory.with_suffix('.vrt')
+    vrt = gdal.BuildVRT(str(vrt_path), tiles)
+    vrt.FlushCache()
+    levels = overview_levels(vrt.RasterXSize, vrt.RasterYSize)
+    vrt = None
+    if levels:
+        for key, value in {
+            'GDAL_NUM_THREADS': str(threads),
+            'COMPRESS_OVERVIEW': 'DEFLATE',
+            'BIGTIFF_OVERVIEW': 'IF_SAFER',
+            'GDAL_TIFF_OVR_BLOCKSIZE': '512',
+        }.items():
+            gdal.SetConfigOption(key, value)
+        # Opened read-only, GDAL writes the overviews to an external .vrt.ovr
+        ds = gdal.Open(str(vrt_path), gdal.GA_ReadOnly)
+        ds.BuildOverviews(resampling, levels)
+        ds = None
+    return vrt_path
+
+
+def build_mosaics(path, products, resampling='AVERAGE', max_workers=None):
+    """Write one VRT with overviews per raster directory of ``path`` named in ``products``."""
+    dirs = product_dirs(path, set(products))
+    if not dirs:
+        return []
+    cpus = os.cpu_count() or 1
+    max_workers = min(max_workers or cpus, len(dirs))
+    threads = max(1, cpus // max_workers)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(build_product, dirs, [resampling] * len(dirs), [threads] * len(dirs)))
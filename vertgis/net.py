@@ -0,0 +1,27 @@
+"""Shared HTTP session factory.
+
+One ``requests.Session`` per engine keeps a pool of keep-alive connections per
+host, so concurrent workers reuse TCP/TLS connections instead of opening a new
+one for every request.
+"""
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+TIMEOUT = 60
+
+
+def make_session(pool_size=10, retries=3, backoff=0.5):
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=('HEAD', 'GET'),
+    )
+    # retries=0 leaves retrying to the caller
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry if retries else 0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['User-Agent'] = 'VertGIS'
+    return session
@@ -0,0 +1,149 @@
+"""Preflight estimate of an extraction job before anything is downloaded.
+
+Asset sizes come from the STAC ``file:size`` of the local catalogue when
+present, otherwise from concurrent HEAD requests. Assets already in the
+shared store cost nothing to fetch. The duration uses the throughput measured
+on previous downloads, persisted in the cache directory.
+"""
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from vertgis import config
+from vertgis.catalog import lookup_assets, asset_checksum
+from vertgis.grid import parse_tile_id
+from vertgis.net import make_session, TIMEOUT
+from vertgis.store import connect as connect_store, lookup as lookup_store, object_key
+
+# Assumed throughput until a download has been measured (bytes/s)
+DEFAULT_RATE = 10 * 1024 ** 2
+# Transfers smaller than this say more about latency than throughput
+MIN_MEASURED_BYTES = 50 * 1024 ** 2
+RATE_FILE = 'throughput.json'
+
+
+def _head_size(session, url):
+    try:
+        r = session.head(url, timeout=TIMEOUT, allow_redirects=True)
+        r.raise_for_status()
+        size = r.headers.get('Content-Length')
+        return int(size) if size is not None else None
+    except Exception:
+        return None
+
+
+def asset_sizes(urls, max_workers=32, session=None):
+    """{url: size in bytes, or None when unknown}."""
+    urls = list(urls)
+    assets = lookup_assets(urls)
+    sizes = {url: assets.get(url, {}).get('file:size') for url in urls}
+    missing = [url for url, size in sizes.items() if size is None]
+    if missing:
+        session = session or make_session(pool_size=max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            sizes.update(zip(missing, pool.map(lambda u: _head_size(session, u), missing)))
+    return sizes
+
+
+def stored_urls(urls, root=None):
+    """URLs whose asset is already in the shared store."""
+    urls = list(urls)
+    checksums = {url: asset_checksum(asset) for url, asset in lookup_assets(urls).items()}
+    con = connect_store(root)
+    try:
+        return {url for url in urls if lookup_store(con, object_key(url, checksums.get(url)), root) is not None}
+    finally:
+        con.close()
+
+
+def load_rate():
+    try:
+        return json.loads((config.CACHE_DIR / RATE_FILE).read_text())['rate']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def record_rate(bytes_done, seconds):
+    """Fold the throughput of a finished download into the persisted estimate."""
+    if bytes_done < MIN_MEASURED_BYTES or seconds <= 0:
+        return load_rate()
+    measured = bytes_done / seconds
+    previous = load_rate()
+    rate = measured if previous is None else 0.5 * previous + 0.5 * measured
+    config.CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = config.CACHE_DIR / RATE_FILE
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps({'rate': rate, 'updated': time.time()}))
+    tmp.replace(path)
+    return rate
+
+
+def estimate(groups, max_workers=32):
+    """Bytes and expected duration of downloading ``groups`` ({product: [urls]}).
+
+    Returns a dict with one entry per product (files, bytes, bytes to
+    download, files of unknown size) plus the totals, the throughput used
+    and the size of every URL.
+    """
+    urls = [url for lst in groups.values() for url in lst]
+    sizes = asset_sizes(urls, max_workers)
+    stored = stored_urls(urls)
+    measured = load_rate()
+    rate = measured or DEFAULT_RATE
+    products = {}
+    for product, lst in groups.items():
+        products[product] = {
+            'files': len(lst),
+            'bytes': sum(sizes[url] or 0 for url in lst),
+            'download_bytes': sum(sizes[url] or 0 for url in lst if url not in stored),
+            'unknown': sum(sizes[url] is None for url in lst),
+        }
+    download_bytes = sum(p['download_bytes'] for p in products.values())
+    return {
+        'products': products,
+        'bytes': sum(p['bytes'] for p in products.values()),
+        'download_bytes': download_bytes,
+        'unknown': sum(p['unknown'] for p in products.values()),
+        'rate': rate,
+        'measured': measured is not None,
+        'seconds': download_bytes / rate,
+        'sizes': sizes,
+        'stored': stored,
+    }
+
+
+def split_batches(urls, sizes, max_bytes, stored=()):
+    """Split ``urls`` into consecutive batches of at most ``max_bytes`` to download.
+
+    A single asset larger than the budget gets a batch of its own.
+    """
+    batches, batch, total = [], [], 0
+    for url in urls:
+        size = 0 if url in stored else sizes.get(url) or 0
+        if batch and total + size > max_bytes:
+            batches.append(batch)
+            batch, total = [], 0
+        batch.append(url)
+        total += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def scope_key(url):
+    # A batch covers tiles of collections, so that a newer asset of one of
+    # its tiles still belongs to it; assets without a tile id are kept as is
+    tile = parse_tile_id(url)
+    if tile is None:
+        return url
+    return f"{url.split('/')[3]}/{tile}"
+
+
+def batch_scope(urls):
+    """Scope of a batch, saved with its query so that syncs stay within it."""
+    return sorted({scope_key(url) for url in urls})
+
+
+def filter_scope(urls, scope):
+    scope = set(scope)
+    return [url for url in urls if scope_key(url) in scope]
@@ -0,0 +1,47 @@
+"""In-process LV95 <-> WGS84 transformations.
+
+Replaces the per-point calls to geodesy.geo.admin.ch/reframe. pyproj applies
+the official CH1903+ -> WGS84 datum shift and the Swiss oblique Mercator
+projection, so planimetric results match the reframe service without any
+network round-trip. All functions accept scalars or array-likes.
+"""
+from functools import lru_cache
+
+import numpy as np
+from pyproj import Transformer
+
+WGS84 = 'EPSG:4326'
+LV95 = 'EPSG:2056'
+
+
+@lru_cache(maxsize=None)
+def _transformer(src, dst):
+    return Transformer.from_crs(src, dst, always_xy=True)
+
+
+def transform_points(x, y, src=WGS84, dst=LV95):
+    scalar = np.isscalar(x) and np.isscalar(y)
+    xx, yy = _transformer(src, dst).transform(np.asarray(x, dtype='float64'), np.asarray(y, dtype='float64'))
+    if scalar:
+        return float(xx), float(yy)
+    return xx, yy
+
+
+def lv95_to_wgs84(easting, northing):
+    return transform_points(easting, northing, LV95, WGS84)
+
+
+def transform_bbox(bbox, src=WGS84, dst=LV95, densify=21):
+    # Envelope of the densified edges, not only of the two corners: the
+    # oblique projection bends the bbox edges.
+    xmin, ymin, xmax, ymax = bbox
+    return tuple(float(v) for v in _transformer(src, dst).transform_bounds(xmin, ymin, xmax, ymax, densify_pts=densify))
+
+
+def bbox_wgs84_to_lv95(bbox):
+    return transform_bbox(bbox, WGS84, LV95)
+
+
+def bbox_lv95_to_wgs84(bbox):
+    return transform_bbox(bbox, LV95, WGS84)
+
@@ -0,0 +1,172 @@
+"""Client for the data.geo.admin.ch STAC API.
+
+Bbox listings are split into cells whose pages are fetched concurrently.
+Searches cannot be split (their pages chain POST bodies), so they follow the
+``next`` links with the request for the following page sent as soon as the
+current one has arrived. Each page is retried on its own with exponential
+backoff; the session does not retry on top of it.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+from vertgis.net import make_session, TIMEOUT
+
+URL_STAC_BASE = 'https://data.geo.admin.ch/api/stac/v0.9/collections/'
+URL_STAC_SEARCH = 'https://data.geo.admin.ch/api/stac/v0.9/search'
+PAGE_LIMIT = 100
+PAGE_ATTEMPTS = 4
+PAGE_BACKOFF = 0.5
+# A cell whose listing spans more than one page is split in SPLIT x SPLIT cells
+SPLIT = 4
+MAX_SPLIT_DEPTH = 1
+LIST_WORKERS = 16
+
+_session = None
+
+
+def get_session():
+    global _session
+    if _session is None:
+        # fetch_page is the only retry layer
+        _session = make_session(pool_size=16, retries=0)
+    return _session
+
+
+def items_url(collection, bbox, limit=PAGE_LIMIT):
+    if not collection.startswith('http'):
+        collection = URL_STAC_BASE + collection
+    xmin, ymin, xmax, ymax = bbox
+    return f'{collection}/items?bbox={xmin},{ymin},{xmax},{ymax}&limit={limit}'
+
+
+def collection_id(collection):
+    return collection.rstrip('/').split('/')[-1]
+
+
+def next_request(page, body=None):
+    # GET listings link to the next URL, POST searches also carry a body
+    for link in page.get('links', []):
+        if link.get('rel') == 'next':
+            if link.get('method', 'GET').upper() == 'POST':
+                next_body = link.get('body', {})
+                if link.get('merge'):
+                    next_body = {**(body or {}), **next_body}
+                return link['href'], next_body
+            return link['href'], None
+    return None, None
+
+
+def _retryable(e):
+    response = getattr(e, 'response', None)
+    return response is None or response.status_code >= 500 or response.status_code in (408, 429)
+
+
+def fetch_page(url, session=None, body=None, attempts=PAGE_ATTEMPTS, backoff=PAGE_BACKOFF):
+    # Only this page is retried, not the listing it belongs to. A session
+    # passed in should not retry itself (make_session(retries=0))
+    session = session or get_session()
+    for attempt in range(attempts):
+        try:
+            if body is None:
+                r = session.get(url, timeout=TIMEOUT)
+            else:
+                r = session.post(url, json=body, timeout=TIMEOUT)
+            r.raise_for_status()
+            return r.json()
+        except (requests.RequestException, ValueError) as e:
+            if attempt == attempts - 1 or not _retryable(e):
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def iter_pages(url, session=None, body=None):
+    # Used for searches: one extra thread holds the request for the next page in flight
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        future = prefetch.submit(fetch_page, url, session, body)
+        while future is not None:
+            page = future.result()
+            url, body = next_request(page, body)
+            future = prefetch.submit(fetch_page, url, session, body) if url else None
+            yield page
+
+
+def split_bbox(bbox, n=SPLIT):
+    xmin, ymin, xmax, ymax = bbox
+    dx, dy = (xmax - xmin) / n, (ymax - ymin) / n
+    return [
+        (xmin + i * dx, ymin + j * dy, xmin + (i + 1) * dx, ymin + (j + 1) * dy)
+        for j in range(n) for i in range(n)
+    ]
+
+
+def list_items(collection, bbox, session=None, max_workers=LIST_WORKERS, max_depth=MAX_SPLIT_DEPTH):
+    """Items of ``collection`` intersecting ``bbox``, listed concurrently.
+
+    The listing starts with one page of the whole bbox. A cell that has a
+    next page is split and its sub-cells are listed in parallel, down to
+    ``max_depth``; below that, cells follow their ``next`` links. Items
+    crossing cell borders are returned once.
+    """
+    session = session or get_session()
+    items = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        def submit(url, cell, depth):
+            pending[pool.submit(fetch_page, url, session)] = (cell, depth)
+
+        pending = {}
+        submit(items_url(collection, bbox), bbox, 0)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                cell, depth = pending.pop(future)
+                page = future.result()
+                for item in page.get('features', []):
+                    items.setdefault(item['id'], item)
+                url, _ = next_request(page)
+                if not url:
+                    continue
+                if depth is not None and depth < max_depth:
+                    for sub in split_bbox(cell):
+                        submit(items_url(collection, sub), sub, depth + 1)
+                else:
+                    # depth None: following the pages of a cell that is not split any more
+                    submit(url, cell, None)
+    return list(items.values())
+
+
+def iter_items(collection, bbox, session=None):
+    yield from list_items(collection, bbox, session)
+
+
+def search_updated_items(collection, bbox, updated_since, session=None):
+    # Items of the bbox whose ``updated`` property is newer than updated_since
+    body = {
+        'collections': [collection_id(collection)],
+        'bbox': list(bbox),
+        'query': {'updated': {'gte': updated_since}},
+        'limit': PAGE_LIMIT,
+    }
+    for page in iter_pages(URL_STAC_SEARCH, session, body):
+        yield from page.get('features', [])
+
+
+def fetch_collection(collection, session=None):
+    if not collection.startswith('http'):
+        collection = URL_STAC_BASE + collection
+    return fetch_page(collection, session)
+
+
+def list_items_many(collections, bbox, max_workers=None, lister=iter_items):
+    """List the items of several collections concurrently.
+
+    ``collections`` maps a key to a collection id or URL; returns a dict with
+    the same keys and the list of items of each collection.
+    """
+    collections = dict(collections)
+    if not collections:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(collections)) as pool:
+        futures = {k: pool.submit(lambda c: list(lister(c, bbox)), c) for k, c in collections.items()}
+        return {k: f.result() for k, f in futures.items()}
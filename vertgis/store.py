@@ -0,0 +1,221 @@
+"""Content-addressed tile store shared by all extractions.
+
+Each downloaded asset is kept once under a key derived from its URL and its
+STAC checksum; extraction folders are assembled from hard links (or reflinks,
+or copies as a last resort) into the store. The store is bounded in size and
+evicts the least recently used objects; files already linked into an
+extraction folder survive the eviction.
+"""
+import errno
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from vertgis import config
+from vertgis.download import download_many, new_hash, verify_file
+
+FICLONE = 0x40049409
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    checksum TEXT,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_access ON objects (last_access);
+"""
+
+
+def connect(root=None):
+    root = Path(root or config.STORE_DIR)
+    root.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(root / 'index.sqlite', timeout=60)
+    con.executescript(SCHEMA)
+    return con
+
+
+def object_key(url, checksum=None):
+    return hashlib.sha256(f'{url}\n{checksum or ""}'.encode()).hexdigest()
+
+
+def object_path(key, root=None):
+    return Path(root or config.STORE_DIR) / 'objects' / key[:2] / key
+
+
+def lookup(con, key, root=None):
+    row = con.execute('SELECT size FROM objects WHERE key=?', (key,)).fetchone()
+    path = object_path(key, root)
+    if row is None or not path.exists():
+        return None
+    with con:
+        con.execute('UPDATE objects SET last_access=? WHERE key=?', (time.time(), key))
+    return path
+
+
+def put(con, key, url, checksum, src, root=None):
+    path = object_path(key, root)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(src, path)
+    with con:
+        con.execute(
+            'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)',
+            (key, url, checksum, path.stat().st_size, time.time()),
+        )
+    return path
+
+
+def link(src, dest):
+    dest = Path(dest)
+    if dest.exists():
+        dest.unlink()
+    try:
+        os.link(src, dest)
+        return 'hardlink'
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as fs, open(dest, 'wb') as fd:
+                fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+            return 'reflink'
+        except OSError:
+            pass
+    shutil.copy2(src, dest)
+    return 'copy'
+
+
+def evict(con, max_bytes=None, root=None):
+    max_bytes = config.STORE_MAX_BYTES if max_bytes is None else max_bytes
+    total = con.execute('SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+    if total <= max_bytes:
+        return 0
+    freed = 0
+    for key, size in con.execute('SELECT key, size FROM objects ORDER BY last_access').fetchall():
+        if total - freed <= max_bytes:
+            break
+        object_path(key, root).unlink(missing_ok=True)
+        with con:
+            con.execute('DELETE FROM objects WHERE key=?', (key,))
+        freed += size
+    return freed
+
+
+def _check_staged(path, checksum):
+    ok = verify_file(path, checksum)
+    if ok is False:
+        path.unlink()
+    return ok
+
+
+def _lock(staged, blocking=False):
+    """Exclusive lock on a staged object across sessions, or None if it is held."""
+    f = open(staged.with_name(staged.name + '.lock'), 'a')
+    if fcntl is None:  # Windows: no locking
+        return f
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+
+def assemble(jobs, checksums=None, root=None, max_bytes=None, on_result=None, **download_kwargs):
+    """Fill each ``(url, dest)`` of ``jobs`` from the store.
+
+    Only objects missing from the store are downloaded (with
+    ``download_many``); ``on_result`` is called with each result once its
+    file is in place. Returns one result dict per job, in order, with a
+    ``cached`` flag. An object being downloaded by another session is
+    waited for rather than fetched twice into the same staging file.
+    """
+    checksums = checksums or {}
+    root = Path(root or config.STORE_DIR)
+    con = connect(root)
+    staging = root / 'staging'
+    staging.mkdir(exist_ok=True)
+    results = [None] * len(jobs)
+    locks = []
+
+    def report(targets, r, path=None):
+        for i, dest in targets:
+            results[i] = dict(r, path=Path(dest))
+            if path is not None:
+                link(path, dest)
+            if on_result:
+                on_result(results[i])
+
+    def from_store(url, key, targets, cached):
+        # Objects stored under a checksum were verified when downloaded
+        path = lookup(con, key, root)
+        if path is None:
+            return False
+        verified = True if new_hash(checksums.get(url)) else None
+        report(targets, {'url': url, 'ok': True, 'size': path.stat().st_size, 'error': None, 'cached': cached, 'verified': verified}, path)
+        return True
+
+    def from_staging(staged, url, key, targets):
+        # Downloaded by an interrupted run: staged files are only renamed
+        # from their .part once complete, so they are not fetched again
+        checksum = checksums.get(url)
+        if not staged.exists() or _check_staged(staged, checksum) is False:
+            return False
+        put(con, key, url, checksum, staged, root)
+        return from_store(url, key, targets, False)
+
+    try:
+        # One download per object, however many jobs ask for it
+        missing = {}
+        for i, (url, dest) in enumerate(jobs):
+            key = object_key(url, checksums.get(url))
+            missing.setdefault(staging / key, (url, key, []))[2].append((i, dest))
+        owned, busy = {}, {}
+        for staged, (url, key, targets) in missing.items():
+            if from_store(url, key, targets, True):
+                continue
+            lock = _lock(staged)
+            if lock is None:
+                busy[staged] = (url, key, targets)
+                continue
+            locks.append(lock)
+            if not from_staging(staged, url, key, targets):
+                owned[staged] = (url, key, targets)
+
+        def done(r):
+            # Staged objects enter the store and are linked as soon as they are complete
+            url, key, targets = owned[Path(r['path'])]
+            path = put(con, key, url, checksums.get(url), staging / key, root) if r['ok'] else None
+            report(targets, dict(r, cached=False), path)
+
+        def download(items):
+            owned.update(items)
+            download_many([(url, staged) for staged, (url, _, _) in items.items()],
+                          checksums=checksums, on_result=done, **download_kwargs)
+
+        download(dict(owned))
+        # Objects other sessions were downloading: wait for them, and only
+        # fetch those they did not manage to store
+        rest = {}
+        for staged, (url, key, targets) in busy.items():
+            locks.append(_lock(staged, blocking=True))
+            if not from_store(url, key, targets, True) and not from_staging(staged, url, key, targets):
+                rest[staged] = (url, key, targets)
+        if rest:
+            download(rest)
+        evict(con, max_bytes, root)
+        return results
+    finally:
+        for lock in locks:
+            lock.close()
+        con.close()
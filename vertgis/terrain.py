@@ -0,0 +1,276 @@
+"""Terrain meshes of a DEM as a 3D Tiles pyramid of glTF tiles.
+
+Every tile of the quadtree samples the DEM on a regular grid of
+``GRID_SIZE`` x ``GRID_SIZE`` points (reading the overviews for the coarse
+levels) and is triangulated with a right-triangulated irregular network
+(RTIN): the grid is refined only where the linear interpolation deviates
+from the DEM by more than the allowed vertical error, which doubles at each
+coarser level. Skirts hide the cracks between neighbouring tiles of
+different detail. Tiles are computed in parallel by a process pool.
+"""
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from pathlib import Path
+
+import numpy as np
+import rasterio
+import trimesh
+from rasterio.enums import Resampling
+from rasterio.windows import from_bounds
+
+from vertgis.tiles3d import enu_frame, to_local, tile_node, write_tileset
+from vertgis.windows import open_cached, bounded_map
+
+GRID_SIZE = 257
+MAX_ERROR = 0.5
+TERRAIN_COLOR = (200, 195, 180, 255)
+
+
+@lru_cache(maxsize=None)
+def rtin_triangles(grid_size=GRID_SIZE):
+    """Vertices a, b (hypotenuse) of every triangle of the RTIN hierarchy.
+
+    Triangles are ordered by depth, the two root triangles first, as in
+    Martini (https://github.com/mapbox/martini). Returns (ax, ay, bx, by).
+    """
+    tile = grid_size - 1
+    ids = np.arange(tile * tile * 2 - 2, dtype='int64') + 2
+    odd = (ids & 1).astype(bool)
+    ax = np.where(odd, 0, tile)
+    ay = ax.copy()
+    bx = np.where(odd, tile, 0)
+    by = bx.copy()
+    cx = np.where(odd, tile, 0)
+    cy = np.where(odd, 0, tile)
+    ids = ids >> 1
+    while True:
+        active = ids > 1
+        if not active.any():
+            break
+        mx, my = (ax + bx) >> 1, (ay + by) >> 1
+        left = (ids & 1).astype(bool)
+        nax = np.where(left, cx, bx)
+        nay = np.where(left, cy, by)
+        nbx = np.where(left, ax, cx)
+        nby = np.where(left, ay, cy)
+        ax, ay = np.where(active, nax, ax), np.where(active, nay, ay)
+        bx, by = np.where(active, nbx, bx), np.where(active, nby, by)
+        cx, cy = np.where(active, mx, cx), np.where(active, my, cy)
+        ids = np.where(active, ids >> 1, ids)
+    return ax, ay, bx, by
+
+
+def triangle_errors(z):
+    """Largest interpolation error inside each triangle of the hierarchy.
+
+    Every grid point descends the hierarchy from its root triangle; at each
+    level its deviation from the plane of its triangle is accumulated on the
+    hypotenuse midpoint of that triangle (shared by the two triangles of a
+    diamond). Triangles mixing data and nodata get an infinite error.
+    """
+    size = z.shape[0]
+    tile = size - 1
+    heights = z.ravel()
+    py, px = np.divmod(np.arange(size * size), size)
+    lower = px >= py
+    ax, ay = np.where(lower, 0, tile), np.where(lower, 0, tile)
+    bx, by = np.where(lower, tile, 0), np.where(lower, tile, 0)
+    cx, cy = np.where(lower, tile, 0), np.where(lower, 0, tile)
+    errors = np.zeros(size * size)
+    # All triangles of a level have the same shape: the whole grid descends in lockstep
+    while abs(ax[0] - cx[0]) + abs(ay[0] - cy[0]) > 1:
+        za, zb, zc = heights[ay * size + ax], heights[by * size + bx], heights[cy * size + cx]
+        det = (by - cy) * (ax - cx) + (cx - bx) * (ay - cy)
+        la = ((by - cy) * (px - cx) + (cx - bx) * (py - cy)) / det
+        lb = ((cy - ay) * (px - cx) + (ax - cx) * (py - cy)) / det
+        err = np.abs(la * za + lb * zb + (1 - la - lb) * zc - heights)
+        nan = np.isnan(err)
+        all_nan = np.isnan(za) & np.isnan(zb) & np.isnan(zc) & np.isnan(heights)
+        err[nan] = np.where(all_nan[nan], 0, np.inf)
+        mx, my = (ax + bx) >> 1, (ay + by) >> 1
+        np.maximum.at(errors, my * size + mx, err)
+        # Children (c, a, m) and (b, c, m): keep the one on the side of the point
+        side = (mx - cx) * (py - cy) - (my - cy) * (px - cx)
+        left = side * ((mx - cx) * (ay - cy) - (my - cy) * (ax - cx)) >= 0
+        ax, ay, bx, by, cx, cy = (
+            np.where(left, cx, bx), np.where(left, cy, by),
+            np.where(left, ax, cx), np.where(left, ay, cy),
+            mx, my,
+        )
+    return errors
+
+
+def rtin_errors(z):
+    """Split error of every grid point of the square grid ``z``.
+
+    A triangle is split when the error at its hypotenuse midpoint exceeds
+    the tolerance; this error bounds the interpolation error inside the
+    triangle and is propagated up the hierarchy so that refinement stays
+    conforming.
+    """
+    size = z.shape[0]
+    tile = size - 1
+    inner = triangle_errors(z)
+    errors = np.zeros(size * size)
+    ax, ay, bx, by = rtin_triangles(size)
+    n_parents = tile * tile - 2
+    # Triangles of one depth are contiguous and split distinct points: one vectorized step per depth
+    depth = int(math.log2(len(ax) + 1))
+    while depth >= 1:
+        lo, hi = (1 << depth) - 2, min((1 << (depth + 1)) - 2, len(ax))
+        tax, tay, tbx, tby = ax[lo:hi], ay[lo:hi], bx[lo:hi], by[lo:hi]
+        mx, my = (tax + tbx) >> 1, (tay + tby) >> 1
+        middle = my * size + mx
+        err = inner[middle]
+        if lo < n_parents:
+            cx, cy = mx + my - tay, my + tax - mx
+            left = ((tay + cy) >> 1) * size + ((tax + cx) >> 1)
+            right = ((tby + cy) >> 1) * size + ((tbx + cx) >> 1)
+            err = np.maximum(err, np.maximum(errors[left], errors[right]))
+        np.maximum.at(errors, middle, err)
+        depth -= 1
+    return errors.reshape(size, size)
+
+
+def rtin_mesh(errors, max_error):
+    """Triangles (n x 3 x 2, grid col/row) of the RTIN mesh within ``max_error``."""
+    size = errors.shape[0]
+    tile = size - 1
+    flat = errors.ravel()
+    tris = np.array([[0, 0, tile, tile, tile, 0], [tile, tile, 0, 0, 0, tile]])
+    res = []
+    while len(tris):
+        ax, ay, bx, by, cx, cy = tris.T
+        mx, my = (ax + bx) >> 1, (ay + by) >> 1
+        split = (np.abs(ax - cx) + np.abs(ay - cy) > 1) & (flat[my * size + mx] > max_error)
+        res.append(tris[~split])
+        t = tris[split]
+        m = np.column_stack([mx[split], my[split]])
+        tris = np.concatenate([
+            np.column_stack([t[:, 4:6], t[:, 0:2], m]),
+            np.column_stack([t[:, 2:4], t[:, 4:6], m]),
+        ])
+    return np.concatenate(res).reshape(-1, 3, 2)
+
+
+def skirts(faces, grid_size):
+    """Border edges of the mesh, as vertex index pairs on the tile edges."""
+    tile = grid_size - 1
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    col, row = edges % grid_size, edges // grid_size
+    on_border = ((col == 0).all(1) | (col == tile).all(1) | (row == 0).all(1) | (row == tile).all(1))
+    return edges[on_border]
+
+
+def sample(src, bounds, grid_size=GRID_SIZE):
+    """DEM heights at ``grid_size`` x ``grid_size`` points spanning ``bounds``, edges included."""
+    xmin, ymin, xmax, ymax = bounds
+    d = (xmax - xmin) / (grid_size - 1)
+    # Pixel centres of the resampled read fall on the sample points
+    window = from_bounds(xmin - d / 2, ymin - d / 2, xmax + d / 2, ymax + d / 2, src.transform)
+    z = src.read(1, window=window, out_shape=(grid_size, grid_size), boundless=True,
+                 fill_value=src.nodata if src.nodata is not None else np.nan,
+                 resampling=Resampling.bilinear).astype('float64')
+    if src.nodata is not None:
+        z[z == src.nodata] = np.nan
+    return z
+
+
+def terrain_tile(dem, grid_size, out_dir, job):
+    """Mesh one tile; returns its tileset node, or None when it holds no data."""
+    key, bounds, max_error, error = job
+    src = open_cached(dem)
+    z = sample(src, bounds, grid_size)
+    if np.isnan(z).all():
+        return None
+    tris = rtin_mesh(rtin_errors(z), max_error)
+    index = tris[..., 1] * grid_size + tris[..., 0]
+    index = index[~np.isnan(z.ravel()[index]).any(axis=1)]
+    if not len(index):
+        return None
+
+    used, faces = np.unique(index, return_inverse=True)
+    faces = faces.reshape(-1, 3)
+    xmin, ymin, xmax, ymax = bounds
+    d = (xmax - xmin) / (grid_size - 1)
+    heights = z.ravel()[used]
+    points = np.column_stack([xmin + (used % grid_size) * d, ymax - (used // grid_size) * d, heights])
+    zmin, zmax = float(heights.min()), float(heights.max())
+
+    # Skirts: the border edges are extended downwards, both ways round
+    drop = max(2 * max_error, d)
+    border = skirts(used[faces], grid_size)
+    if len(border):
+        border = np.searchsorted(used, border)
+        low = np.column_stack([points[border.ravel(), :2], points[border.ravel(), 2] - drop])
+        base = len(points)
+        p, q = border[:, 0], border[:, 1]
+        lp, lq = base + 2 * np.arange(len(border)), base + 2 * np.arange(len(border)) + 1
+        faces = np.concatenate([faces, np.column_stack([p, q, lq]), np.column_stack([p, lq, lp]),
+                                np.column_stack([q, p, lp]), np.column_stack([q, lp, lq])])
+        points = np.concatenate([points, low])
+
+    frame = enu_frame((xmin + xmax) / 2, (ymin + ymax) / 2, zmin)
+    mesh = trimesh.Trimesh(to_local(points, frame), faces, process=False)
+    mesh.visual = trimesh.visual.ColorVisuals(mesh, vertex_colors=np.tile(TERRAIN_COLOR, (len(points), 1)).astype('uint8'))
+    depth, x, y = key
+    uri = f'tiles/{depth}/{x}/{y}.glb'
+    path = Path(out_dir) / uri
+    path.parent.mkdir(parents=True, exist_ok=True)
+    mesh.export(path, file_type='glb')
+    return tile_node(bounds, zmin - drop, zmax, error, frame, uri), len(index)
+
+
+def plan_pyramid(bounds, res, grid_size=GRID_SIZE, max_error=MAX_ERROR, max_level=None):
+    """Tiles ((depth, x, y), bounds, max_error, geometric_error) of the pyramid over ``bounds``.
+
+    The root is the square around ``bounds``; the leaves sample the DEM at
+    about its resolution ``res``. Tiles are listed level by level, root first.
+    """
+    xmin, ymin, xmax, ymax = bounds
+    size = max(xmax - xmin, ymax - ymin)
+    if max_level is None:
+        max_level = max(0, math.ceil(math.log2(size / ((grid_size - 1) * res))))
+    for depth in range(max_level + 1):
+        n = 1 << depth
+        step = size / n
+        level_error = max_error * (1 << (max_level - depth))
+        geometric_error = 0.0 if depth == max_level else level_error
+        for y in range(n):
+            top = ymin + size - y * step
+            if top - step >= ymax:
+                continue
+            for x in range(n):
+                left = xmin + x * step
+                if left >= xmax:
+                    continue
+                yield (depth, x, y), (left, top - step, left + step, top), level_error, geometric_error
+
+
+def build_terrain(dem, out_dir, max_error=MAX_ERROR, max_level=None, grid_size=GRID_SIZE, max_workers=None):
+    """Write a terrain tileset of ``dem`` (LV95) within ``max_error`` meters at full detail.
+
+    Returns (path of ``tileset.json``, number of triangles of the leaf level).
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with rasterio.open(dem) as src:
+        bounds = tuple(src.bounds)
+        res = max(src.res)
+    jobs = list(plan_pyramid(bounds, res, grid_size, max_error, max_level))
+    leaf_depth = jobs[-1][0][0]
+    max_workers = max_workers or os.cpu_count() or 1
+    nodes = {}
+    n_triangles = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        work = partial(terrain_tile, str(dem), grid_size, str(out_dir))
+        for job, out in bounded_map(pool, work, jobs, 2 * max_workers):
+            if out is None:
+                continue
+            node, count = out
+            nodes[job[0]] = node
+            if job[0][0] == leaf_depth:
+                n_triangles += count
+    return write_tileset(nodes, out_dir), n_triangles
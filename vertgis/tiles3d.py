@@ -0,0 +1,261 @@
+"""3D Tiles (glTF content) with levels of detail from swissBUILDINGS3D.
+
+Buildings are distributed in a quadtree until a tile holds at most
+``MAX_BUILDINGS_PER_TILE`` of them. Leaf tiles carry the full triangulated
+buildings; every parent tile carries one merged mesh of simplified buildings
+(convex footprint extruded between the lowest and highest point), keeping
+only its largest buildings. Each tile is a ``.glb`` in a local east-north-up
+frame placed on the globe by the tile transform, which keeps float32
+vertex precision. Tiles are written by a process pool.
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import shapely
+import trimesh
+from pyproj import Transformer
+
+from vertgis.reframe import LV95, lv95_to_wgs84, bbox_lv95_to_wgs84
+
+ECEF = 'EPSG:4978'
+# Heights are LN02; the geoid is ~49.5 m above the WGS84 ellipsoid in Switzerland
+GEOID_HEIGHT = 49.5
+MAX_BUILDINGS_PER_TILE = 1000
+MAX_DEPTH = 10
+WALL_COLOR = (220, 220, 215, 255)
+ROOF_COLOR = (170, 75, 60, 255)
+
+
+@lru_cache(maxsize=None)
+def _to_ecef():
+    return Transformer.from_crs(LV95, ECEF, always_xy=True)
+
+
+def enu_frame(x, y, z):
+    """4x4 matrix from the east-north-up frame at the LV95 point (x, y, z) to ECEF."""
+    origin = np.array(_to_ecef().transform(x, y, z + GEOID_HEIGHT))
+    lon, lat = np.radians(lv95_to_wgs84(x, y))
+    east = np.array([-np.sin(lon), np.cos(lon), 0])
+    north = np.array([-np.sin(lat) * np.cos(lon), -np.sin(lat) * np.sin(lon), np.cos(lat)])
+    up = np.array([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+    frame = np.eye(4)
+    frame[:3, 0], frame[:3, 1], frame[:3, 2], frame[:3, 3] = east, north, up, origin
+    return frame
+
+
+def to_local(points, frame):
+    """LV95 points (n x 3) to the ENU frame, as glTF y-up coordinates (east, up, -north)."""
+    ecef = np.column_stack(_to_ecef().transform(points[:, 0], points[:, 1], points[:, 2] + GEOID_HEIGHT))
+    enu = (ecef - frame[:3, 3]) @ frame[:3, :3]
+    return np.column_stack([enu[:, 0], enu[:, 2], -enu[:, 1]])
+
+
+def _normal(ring):
+    # Newell's method, robust for non-convex and slightly non-planar faces
+    x, y, z = ring[:, 0], ring[:, 1], ring[:, 2]
+    x1, y1, z1 = np.roll(x, -1), np.roll(y, -1), np.roll(z, -1)
+    return np.array([((y - y1) * (z + z1)).sum(), ((z - z1) * (x + x1)).sum(), ((x - x1) * (y + y1)).sum()])
+
+
+def triangulate_face(polygon):
+    """Triangles (n x 3 x 3) of a planar 3D polygon, holes included."""
+    ring = shapely.get_coordinates(polygon.exterior, include_z=True)
+    n = _normal(ring)
+    norm = np.linalg.norm(n)
+    if norm == 0 or np.isnan(norm):
+        return np.empty((0, 3, 3))
+    n = n / norm
+    # Triangulate in the axis plane the face projects best onto, then lift back onto the face plane
+    k = int(np.argmax(np.abs(n)))
+    axes = [i for i in range(3) if i != k]
+    flat = shapely.Polygon(
+        ring[:, axes],
+        [shapely.get_coordinates(r, include_z=True)[:, axes] for r in polygon.interiors],
+    )
+    if not flat.is_valid:
+        flat = shapely.make_valid(flat)
+    triangles = shapely.get_parts(shapely.constrained_delaunay_triangles(flat))
+    if not len(triangles):
+        return np.empty((0, 3, 3))
+    uv = shapely.get_coordinates(triangles).reshape(-1, 4, 2)[:, :3]
+    d = n @ ring[0]
+    res = np.empty(uv.shape[:2] + (3,))
+    res[..., axes[0]], res[..., axes[1]] = uv[..., 0], uv[..., 1]
+    res[..., k] = (d - n[axes[0]] * uv[..., 0] - n[axes[1]] * uv[..., 1]) / n[k]
+    # Keep the winding of the original face
+    cross = np.cross(res[:, 1] - res[:, 0], res[:, 2] - res[:, 0])
+    flip = cross @ n < 0
+    res[flip] = res[flip][:, ::-1]
+    return res
+
+
+def building_triangles(geom):
+    """Triangles (n x 3 x 3, LV95) of a building made of 3D polygon faces."""
+    faces = [p for p in shapely.get_parts(geom) if p.geom_type == 'Polygon']
+    lst = [triangulate_face(p) for p in faces]
+    lst = [t for t in lst if len(t)]
+    return np.concatenate(lst) if lst else np.empty((0, 3, 3))
+
+
+def prism_triangles(geom):
+    """Simplified building: its convex footprint extruded from its lowest to its highest point."""
+    coords = shapely.get_coordinates(geom, include_z=True)
+    zmin, zmax = coords[:, 2].min(), coords[:, 2].max()
+    hull = shapely.convex_hull(shapely.MultiPoint(coords[:, :2]))
+    if hull.geom_type != 'Polygon':
+        return np.empty((0, 3, 3))
+    ring = shapely.get_coordinates(shapely.orient_polygons(hull))[:-1]
+    n = len(ring)
+    bottom = np.column_stack([ring, np.full(n, zmin)])
+    top = np.column_stack([ring, np.full(n, zmax)])
+    i = np.arange(1, n - 1)
+    tris = [
+        np.stack([top[np.zeros_like(i)], top[i], top[i + 1]], axis=1),
+        np.stack([bottom[np.zeros_like(i)], bottom[i + 1], bottom[i]], axis=1),
+    ]
+    j, j1 = np.arange(n), (np.arange(n) + 1) % n
+    tris += [np.stack([bottom[j], bottom[j1], top[j1]], axis=1), np.stack([bottom[j], top[j1], top[j]], axis=1)]
+    return np.concatenate(tris)
+
+
+def tile_mesh(triangles, frame):
+    vertices = to_local(triangles.reshape(-1, 3), frame)
+    faces = np.arange(len(vertices)).reshape(-1, 3)
+    mesh = trimesh.Trimesh(vertices, faces, process=False)
+    # Roofs in red, walls in grey (normals are in glTF y-up space)
+    roof = mesh.face_normals[:, 1] > 0.3
+    colors = np.where(roof[:, None], ROOF_COLOR, WALL_COLOR).astype('uint8')
+    mesh.visual = trimesh.visual.ColorVisuals(mesh, face_colors=colors)
+    mesh.merge_vertices()
+    return mesh
+
+
+def write_tile(path, wkbs, simplified, frame):
+    geoms = shapely.from_wkb(wkbs)
+    make = prism_triangles if simplified else building_triangles
+    lst = [t for t in (make(g) for g in geoms) if len(t)]
+    if not lst:
+        return False
+    mesh = tile_mesh(np.concatenate(lst), frame)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    mesh.export(path, file_type='glb')
+    return True
+
+
+def _region(bounds, zmin, zmax):
+    # 3D Tiles bounding region: radians and ellipsoidal heights
+    west, south, east, north = bbox_lv95_to_wgs84(bounds)
+    return [float(v) for v in np.radians([west, south, east, north])] + [zmin + GEOID_HEIGHT, zmax + GEOID_HEIGHT]
+
+
+def plan_tiles(centers, bounds, idx=None, depth=0, x=0, y=0, max_buildings=MAX_BUILDINGS_PER_TILE):
+    """Quadtree of building indices: yields (depth, x, y, indices, is_leaf), parents first."""
+    if idx is None:
+        idx = np.arange(len(centers))
+    leaf = len(idx) <= max_buildings or depth == MAX_DEPTH
+    yield depth, x, y, idx, leaf
+    if leaf:
+        return
+    xmin, ymin, xmax, ymax = bounds
+    xmid, ymid = (xmin + xmax) / 2, (ymin + ymax) / 2
+    east = centers[idx, 0] >= xmid
+    north = centers[idx, 1] >= ymid
+    for dx, dy, sel, sub in (
+        (0, 1, ~east & ~north, (xmin, ymin, xmid, ymid)),
+        (1, 1, east & ~north, (xmid, ymin, xmax, ymid)),
+        (0, 0, ~east & north, (xmin, ymid, xmid, ymax)),
+        (1, 0, east & north, (xmid, ymid, xmax, ymax)),
+    ):
+        if sel.any():
+            yield from plan_tiles(centers, sub, idx[sel], depth + 1, 2 * x + dx, 2 * y + dy, max_buildings)
+
+
+def build_tileset(buildings, out_dir, max_buildings=MAX_BUILDINGS_PER_TILE, max_workers=None):
+    """Write ``tileset.json`` and its ``.glb`` tiles for the LV95 GeoDataFrame ``buildings``.
+
+    Returns the path of ``tileset.json``.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    geoms = buildings.geometry.values
+    geoms = np.asarray(geoms[~shapely.is_empty(geoms)])
+    if not len(geoms):
+        raise ValueError("No building geometry to tile")
+    wkbs = shapely.to_wkb(geoms)
+    bounds2d = shapely.bounds(geoms)
+    coords = [shapely.get_coordinates(g, include_z=True)[:, 2] for g in geoms]
+    zmin = np.array([np.nanmin(z) for z in coords])
+    zmax = np.array([np.nanmax(z) for z in coords])
+    centers = np.column_stack([(bounds2d[:, 0] + bounds2d[:, 2]) / 2, (bounds2d[:, 1] + bounds2d[:, 3]) / 2])
+    area = shapely.area(shapely.convex_hull(shapely.force_2d(geoms)))
+    root_bounds = tuple(shapely.total_bounds(geoms))
+
+    nodes = {}
+    jobs = []
+    for depth, x, y, idx, leaf in plan_tiles(centers, root_bounds, max_buildings=max_buildings):
+        tb = (bounds2d[idx, 0].min(), bounds2d[idx, 1].min(), bounds2d[idx, 2].max(), bounds2d[idx, 3].max())
+        if leaf:
+            shown, error = idx, 0.0
+        else:
+            # The largest buildings, simplified; the error is the tallest building left out or boxed
+            shown = idx[np.argsort(-area[idx], kind='stable')[:max_buildings]]
+            error = float(max((zmax[idx] - zmin[idx]).max(), (tb[2] - tb[0]) / 64))
+        uri = f'tiles/{depth}/{x}/{y}.glb'
+        frame = enu_frame((tb[0] + tb[2]) / 2, (tb[1] + tb[3]) / 2, float(zmin[idx].min()))
+        nodes[(depth, x, y)] = tile_node(tb, float(zmin[idx].min()), float(zmax[idx].max()), error, frame, uri)
+        jobs.append((str(out_dir / uri), wkbs[shown], not leaf, frame, (depth, x, y)))
+
+    max_workers = max_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        written = pool.map(write_tile, *zip(*[job[:4] for job in jobs]), chunksize=4)
+        for job, ok in zip(jobs, written):
+            if not ok:
+                del nodes[job[4]]['content']
+    return write_tileset(nodes, out_dir)
+
+
+def tile_node(bounds, zmin, zmax, error, frame, uri):
+    """A tileset node for a tile covering ``bounds`` (LV95) with its content at ``uri``."""
+    return {
+        'boundingVolume': {'region': _region(bounds, zmin, zmax)},
+        'geometricError': error,
+        'refine': 'REPLACE',
+        'transform': [float(v) for v in frame.T.ravel()],
+        'content': {'uri': uri},
+    }
+
+
+def write_tileset(nodes, out_dir):
+    """Assemble {(depth, x, y): node} as a quadtree and write ``tileset.json``.
+
+    Node transforms are absolute (ENU -> ECEF); they are made relative to
+    the parent tile, since 3D Tiles compose them down the tree. Raises
+    ValueError when there is no root tile, e.g. for an all-nodata DEM.
+    """
+    if (0, 0, 0) not in nodes:
+        raise ValueError('No root tile to write: the input holds no data')
+    for (depth, x, y), node in sorted(nodes.items(), reverse=True):
+        parent = nodes.get((depth - 1, x // 2, y // 2))
+        if depth and parent is not None:
+            parent.setdefault('children', []).insert(0, node)
+    root = nodes[(0, 0, 0)]
+    _relative_transforms(root, np.eye(4))
+    tileset = {
+        'asset': {'version': '1.1', 'generator': 'vertgis'},
+        'geometricError': root['geometricError'] * 2,
+        'root': root,
+    }
+    path = Path(out_dir) / 'tileset.json'
+    path.write_text(json.dumps(tileset))
+    return path
+
+
+def _relative_transforms(node, parent):
+    absolute = np.array(node['transform']).reshape(4, 4).T
+    node['transform'] = [float(v) for v in (np.linalg.inv(parent) @ absolute).T.ravel()]
+    for child in node.get('children', []):
+        _relative_transforms(child, absolute)
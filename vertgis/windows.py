@@ -0,0 +1,66 @@
+"""Block iteration helpers for rasters too large to hold in memory."""
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+BLOCK_SIZE = 1024
+
+_datasets = {}
+
+
+def open_cached(path):
+    # One read handle per raster and per worker process
+    if path not in _datasets:
+        _datasets[path] = rasterio.open(path)
+    return _datasets[path]
+
+
+def iter_windows(width, height, block=BLOCK_SIZE):
+    for row in range(0, height, block):
+        for col in range(0, width, block):
+            yield Window(col, row, min(block, width - col), min(block, height - row))
+
+
+def read_with_halo(src, window, halo=1, band=1):
+    """Read ``window`` plus ``halo`` pixels around it as float32.
+
+    Nodata becomes NaN; outside the raster the edge pixels are repeated so
+    that kernels do not produce artificial borders.
+    """
+    col0, row0 = window.col_off - halo, window.row_off - halo
+    col1, row1 = window.col_off + window.width + halo, window.row_off + window.height + halo
+    c0, r0 = max(col0, 0), max(row0, 0)
+    c1, r1 = min(col1, src.width), min(row1, src.height)
+    data = src.read(band, window=Window(c0, r0, c1 - c0, r1 - r0)).astype('float32')
+    if src.nodata is not None:
+        data[data == src.nodata] = np.nan
+    pad = ((r0 - row0, row1 - r1), (c0 - col0, col1 - c1))
+    if any(any(p) for p in pad):
+        data = np.pad(data, pad, mode='edge')
+    return data
+
+
+def bounded_map(pool, fn, iterable, max_pending):
+    """Like ``pool.map`` but with at most ``max_pending`` tasks in flight.
+
+    Results are yielded as ``(item, result)`` in completion order, which
+    keeps memory bounded whatever the number of blocks.
+    """
+    items = iter(iterable)
+    pending = {}
+
+    def submit_next():
+        for item in items:
+            pending[pool.submit(fn, item)] = item
+            return
+
+    for _ in range(max_pending):
+        submit_next()
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            item = pending.pop(fut)
+            submit_next()
+            yield item, fut.result()
@@ -0,0 +1,289 @@
+"""Zonal statistics of rasters over many polygons.
+
+All zones are rasterized once into a label grid covering their extent, one
+band per set of non-overlapping zones, so overlapping zones each keep all
+their pixels. The label grid and
+the value rasters are then read block by block in a process pool, and each
+block is reduced per label with vectorized NumPy operations: count, sum,
+min and max exactly, and percentiles from a sparse per-label histogram whose
+bins are ``bin_width`` wide (raster units).
+"""
+import math
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import rasterio
+import shapely
+from rasterio.enums import Resampling
+from rasterio.features import rasterize
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window, from_bounds, intersect, bounds as window_bounds, transform as window_transform
+
+from vertgis.windows import BLOCK_SIZE, iter_windows, bounded_map
+
+STATS = ('count', 'mean', 'max', 'p10', 'p50', 'p90')
+BIN_WIDTH = 0.1
+MAX_HIST_ENTRIES = 4_000_000
+
+# Histogram keys pack the label and the bin index into a single int64
+_BIN_OFFSET = 1 << 31
+
+_datasets = {}
+
+
+def _dataset(path, grid):
+    # A read handle on ``path`` aligned to the label grid, and the pixel offset of the grid in it
+    key = (path, grid)
+    if key not in _datasets:
+        crs, transform, width, height = grid[:4]
+        transform = rasterio.Affine(*transform)
+        src = rasterio.open(path)
+        col, row = ~src.transform * (transform.c, transform.f)
+        aligned = (
+            src.crs == rasterio.crs.CRS.from_wkt(crs)
+            and np.allclose(src.transform[:2] + src.transform[3:5], transform[:2] + transform[3:5])
+            and abs(col - round(col)) < 1e-6 and abs(row - round(row)) < 1e-6
+        )
+        if aligned:
+            _datasets[key] = (src, int(round(col)), int(round(row)))
+        else:
+            # The alpha band tells the pixels outside the raster
+            vrt = WarpedVRT(src, crs=crs, transform=transform, width=width, height=height,
+                            resampling=Resampling.nearest, add_alpha=True)
+            _datasets[key] = (vrt, 0, 0)
+    return _datasets[key]
+
+
+def _read(path, grid, window, dtype='float32', band=1):
+    # Pixels outside the raster are 0 for labels, NaN for values, like nodata
+    src, col, row = _dataset(path, grid)
+    window = Window(window.col_off + col, window.row_off + row, window.width, window.height)
+    if isinstance(src, WarpedVRT):
+        # The warped VRT covers the whole grid
+        data = src.read(band, window=window)
+        missing = src.read(src.count, window=window) == 0
+    else:
+        # Aligned rasters may only cover part of it
+        data = src.read(band, window=window, boundless=True, masked=True)
+        data, missing = data.data, np.ma.getmaskarray(data)
+    if src.nodata is not None:
+        missing |= data == src.nodata
+    if dtype != 'float32':
+        return np.where(missing, 0, data).astype(dtype)
+    return np.where(missing, np.nan, data).astype('float32')
+
+
+def reduce_block(labels, values, bin_width=BIN_WIDTH):
+    """Per-label count, sum, min, max and sparse histogram of one block."""
+    valid = (labels > 0) & ~np.isnan(values)
+    labels = labels[valid].astype('int64')
+    values = values[valid]
+    if not labels.size:
+        return None
+    order = np.argsort(labels, kind='stable')
+    labels, values = labels[order], values[order]
+    ids, starts, counts = np.unique(labels, return_index=True, return_counts=True)
+    bins = np.floor(values / bin_width).astype('int64') + _BIN_OFFSET
+    keys, hist = np.unique((labels << 32) | bins, return_counts=True)
+    return {
+        'ids': ids,
+        'count': counts,
+        'sum': np.add.reduceat(values.astype('float64'), starts),
+        'min': np.minimum.reduceat(values, starts),
+        'max': np.maximum.reduceat(values, starts),
+        'keys': keys,
+        'hist': hist,
+    }
+
+
+def compute_block(labels_path, rasters, grid, bin_width, window):
+    """{raster name: [reduced block per label band]} of ``window``."""
+    layers = [_read(labels_path, grid, window, dtype='int64', band=b) for b in range(1, grid[4] + 1)]
+    layers = [labels for labels in layers if labels.any()]
+    if not layers:
+        return {}
+    res = {}
+    for name, path in rasters.items():
+        values = _read(path, grid, window)
+        res[name] = [reduce_block(labels, values, bin_width) for labels in layers]
+    return res
+
+
+def _merge_hist(parts):
+    keys = np.concatenate([k for k, _ in parts])
+    counts = np.concatenate([c for _, c in parts])
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=counts).astype('int64')
+
+
+class _Accumulator:
+    def __init__(self, n_labels):
+        size = n_labels + 1
+        self.count = np.zeros(size, 'int64')
+        self.sum = np.zeros(size, 'float64')
+        self.min = np.full(size, np.inf)
+        self.max = np.full(size, -np.inf)
+        self.hist = []
+        self.hist_size = 0
+
+    def add(self, block):
+        ids = block['ids']
+        self.count[ids] += block['count']
+        self.sum[ids] += block['sum']
+        self.min[ids] = np.minimum(self.min[ids], block['min'])
+        self.max[ids] = np.maximum(self.max[ids], block['max'])
+        self.hist.append((block['keys'], block['hist']))
+        self.hist_size += len(block['keys'])
+        if self.hist_size > MAX_HIST_ENTRIES:
+            self.hist = [_merge_hist(self.hist)]
+            self.hist_size = len(self.hist[0][0])
+
+    def percentiles(self, qs, bin_width):
+        res = {q: np.full(len(self.count), np.nan) for q in qs}
+        if not self.hist:
+            return res
+        keys, counts = _merge_hist(self.hist)
+        labels = keys >> 32
+        values = ((keys & 0xFFFFFFFF) - _BIN_OFFSET + 0.5) * bin_width
+        cum = np.cumsum(counts)
+        ids, starts = np.unique(labels, return_index=True)
+        before = cum[starts] - counts[starts]
+        n = self.count[ids]
+        for q in qs:
+            # Nearest rank, clamped to the exact extremes
+            rank = before + np.maximum(1, np.ceil(q / 100 * n)).astype('int64')
+            idx = np.searchsorted(cum, rank)
+            res[q][ids] = np.clip(values[idx], self.min[ids], self.max[ids])
+        return res
+
+    def stats(self, stats, bin_width):
+        qs = [float(s[1:]) for s in stats if s.startswith('p')]
+        percentiles = self.percentiles(qs, bin_width) if qs else {}
+        empty = self.count == 0
+        res = {}
+        for stat in stats:
+            if stat == 'count':
+                data = self.count
+            elif stat == 'sum':
+                data = np.where(empty, np.nan, self.sum)
+            elif stat == 'mean':
+                data = np.where(empty, np.nan, self.sum / np.maximum(self.count, 1))
+            elif stat in ('min', 'max'):
+                data = np.where(empty, np.nan, getattr(self, stat))
+            else:
+                data = percentiles[float(stat[1:])]
+            res[stat] = data[1:]
+        return res
+
+
+def overlap_layers(geoms):
+    """Layer index of every zone, so that zones of a layer never overlap.
+
+    Zones only touching along their boundary may share a layer. The zones
+    are assigned greedily to the first layer none of their overlapping
+    neighbours is in, which is one layer when no zones overlap.
+    """
+    tree = shapely.STRtree(geoms)
+    a, b = tree.query(geoms, predicate='intersects')
+    keep = (a != b)
+    a, b = a[keep], b[keep]
+    # Interiors intersect
+    overlap = shapely.relate_pattern(geoms[a], geoms[b], 'T********')
+    neighbours = [[] for _ in range(len(geoms))]
+    for i, j in zip(a[overlap], b[overlap]):
+        if j < i:
+            neighbours[i].append(j)
+    layers = np.zeros(len(geoms), 'int64')
+    for i in range(len(geoms)):
+        used = {layers[j] for j in neighbours[i]}
+        layer = 0
+        while layer in used:
+            layer += 1
+        layers[i] = layer
+    return layers
+
+
+def label_grid(geoms, reference, path, block=BLOCK_SIZE):
+    """Rasterize ``geoms`` once as labels 1..n on the grid of ``reference``.
+
+    The grid is cut to the extent of the zones and has one band per set of
+    non-overlapping zones (see overlap_layers). Returns the grid as
+    ``(crs_wkt, transform, width, height, bands)``, or None when no zone
+    overlaps the raster.
+    """
+    with rasterio.open(reference) as src:
+        left, bottom, right, top = shapely.total_bounds(geoms)
+        zw = from_bounds(left, bottom, right, top, src.transform)
+        col0, row0 = math.floor(zw.col_off), math.floor(zw.row_off)
+        window = Window(col0, row0, math.ceil(zw.col_off + zw.width) - col0, math.ceil(zw.row_off + zw.height) - row0)
+        full = Window(0, 0, src.width, src.height)
+        if not intersect(window, full):
+            return None
+        window = window.intersection(full)
+        transform = window_transform(window, src.transform)
+        width, height = int(window.width), int(window.height)
+        crs = src.crs
+    tree = shapely.STRtree(geoms)
+    layers = overlap_layers(geoms)
+    bands = int(layers.max()) + 1
+    profile = dict(
+        driver='GTiff', width=width, height=height, count=bands, crs=crs, transform=transform,
+        dtype='uint32', nodata=0, tiled=True, blockxsize=512, blockysize=512, compress='deflate',
+        BIGTIFF='IF_SAFER',
+    )
+    with rasterio.open(path, 'w', **profile) as dst:
+        for win in iter_windows(width, height, block):
+            hits = np.sort(tree.query(shapely.box(*window_bounds(win, transform))))
+            if not len(hits):
+                continue
+            for band in range(bands):
+                ids = hits[layers[hits] == band]
+                if not len(ids):
+                    continue
+                labels = rasterize(
+                    zip(geoms[ids], ids + 1), out_shape=(int(win.height), int(win.width)),
+                    transform=window_transform(win, transform), dtype='uint32',
+                )
+                dst.write(labels, band + 1, window=win)
+    return crs.to_wkt(), tuple(transform)[:6], width, height, bands
+
+
+def zonal_stats(zones, rasters, stats=STATS, bin_width=BIN_WIDTH, block=BLOCK_SIZE, max_workers=None):
+    """Statistics of every raster of ``rasters`` ({name: path}) over every zone.
+
+    ``zones`` is a GeoDataFrame of polygons; the zones are rasterized on the
+    grid of the first raster, the others are resampled onto it if needed.
+    Stats are ``count``, ``sum``, ``mean``, ``min``, ``max`` and percentiles
+    ``pNN``. Returns a copy of ``zones`` with one ``<name>_<stat>`` column
+    per raster and stat.
+    """
+    rasters = {name: str(path) for name, path in rasters.items()}
+    with rasterio.open(next(iter(rasters.values()))) as src:
+        crs = src.crs
+    res = zones.copy()
+    geoms = zones.geometry.to_crs(crs).values if zones.crs else zones.geometry.values
+    geoms = shapely.force_2d(np.asarray(geoms))
+    accumulators = {name: _Accumulator(len(zones)) for name in rasters}
+    max_workers = max_workers or os.cpu_count() or 1
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        labels_path = str(Path(tmpdir) / 'labels.tif')
+        grid = label_grid(geoms, next(iter(rasters.values())), labels_path, block) if len(geoms) else None
+        if grid is not None:
+            windows = list(iter_windows(grid[2], grid[3], block))
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                work = partial(compute_block, labels_path, rasters, grid, bin_width)
+                for _, blocks in bounded_map(pool, work, windows, 2 * max_workers):
+                    for name, reduced in blocks.items():
+                        for part in reduced:
+                            if part is not None:
+                                accumulators[name].add(part)
+
+    for name, acc in accumulators.items():
+        for stat, data in acc.stats(stats, bin_width).items():
+            res[f'{name}_{stat}'] = data
+    return res